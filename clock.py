@@ -16,6 +16,8 @@ secs = polar_line(origin, 50, 1)
 mins = polar_line(origin, 50, 2)
 hours = polar_line(origin, 30, 4)
 
+a.register_font('big', '/sd/LiberationSerif-Regular45x44') # Open once
+
 with a:
     a.clear_screen()
     while True:
@@ -24,7 +26,7 @@ with a:
         t = time.localtime()
         h, m, s = t[3:6]
         hh = h + m /60
-        with a.font('/sd/LiberationSerif-Regular45x44'):
+        with a.font('big'):
             a.locate(0,0)
             a.puts('{:02d}.{:02d}.{:02d}'.format(h, m, s))
         secs(2 * math.pi * s/60)
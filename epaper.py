@@ -23,7 +23,12 @@
 # Code translated and developed from https://developer.mbed.org/users/dreschpe/code/EaEpaper/
 
 import pyb, gc, uos
+from array import array
 from panel import NORMAL, FAST, EMBEDDED_ARTISTS, ADAFRUIT
+try:
+    import framebuf                             # Native drawing where available
+except ImportError:
+    framebuf = None
 LINES_PER_DISPLAY = const(176)  # 2.7 inch panel only!
 BYTES_PER_LINE = const(33)
 BITS_PER_LINE = const(264)
@@ -32,6 +37,17 @@ gc.collect()
 
 NEWLINE = const(10)             # ord('\n')
 
+COPY = const(0)                 # blit() raster operations
+OR = const(1)
+AND = const(2)
+XOR = const(3)
+NOT = const(4)                  # Copy inverted source
+
+LEFT = const(0)                 # textbox() alignment
+CENTRE = const(1)
+RIGHT = const(2)
+JUSTIFY = const(3)
+
 class EPDError(OSError):
     pass
 
@@ -39,6 +55,46 @@ def checkstate(state, msg):
     if not state:
         raise EPDError(msg)
 
+# Cohen-Sutherland outcode of a point relative to a clip rectangle (inclusive)
+def _outcode(x, y, xmin, ymin, xmax, ymax):
+    code = 0
+    if x < xmin:
+        code = 1
+    elif x > xmax:
+        code = 2
+    if y < ymin:
+        code |= 4
+    elif y > ymax:
+        code |= 8
+    return code
+
+# Range k0..k1 of the steps of a Bresenham line which lie within a clip
+# rectangle (inclusive). The line steps along its major axis a from a0, its
+# minor coordinate after k steps being b0 + sb * ((2 * db * k + da) // (2 * da)).
+# Returns None if no pixel lies within the rectangle.
+def _clipspan(a0, sa, da, amin, amax, b0, sb, db, bmin, bmax):
+    if sa > 0:
+        k0 = amin - a0
+        k1 = amax - a0
+    else:
+        k0 = a0 - amax
+        k1 = a0 - amin
+    k0 = max(k0, 0)
+    k1 = min(k1, da)
+    if sb > 0:                                  # Limits of minor steps
+        mlo = bmin - b0
+        mhi = bmax - b0
+    else:
+        mlo = b0 - bmax
+        mhi = b0 - bmin
+    if db == 0:
+        if mlo > 0 or mhi < 0:
+            return None
+    else:
+        k0 = max(k0, -((da - 2 * da * mlo) // (2 * db)))
+        k1 = min(k1, (2 * da * (mhi + 1) - da - 1) // (2 * db))
+    return None if k0 > k1 else (k0, k1)
+
 # Generator parses an XBM file returning width, height, followed by data bytes
 def get_xbm_data(sourcefile):
     errmsg = ''.join(("File: '", sourcefile, "' is not a valid XBM file"))
@@ -72,12 +128,667 @@ def get_xbm_data(sourcefile):
     except OSError:
         print("Can't open " + sourcefile + " for reading")
 
+# Streaming XBM parser. The file is read in fixed size chunks into a reused
+# buffer and decoded by a byte level state machine: no strings are created.
+# Parser state persists between chunks in an array('i') with these indices.
+_XBM_PHASE = const(0)           # 0 line start, 1 #define, 2 other line, 3 data, 4 end
+_XBM_ACC = const(1)             # Hex value being accumulated
+_XBM_INTOK = const(2)           # In a hex token (data) or digit run (#define)
+_XBM_NUM = const(3)             # Last decimal number on a #define line
+_XBM_NDEFS = const(4)           # No. of #defines parsed
+_XBM_WIDTH = const(5)           # Must follow _XBM_NDEFS: width, height
+_XBM_POS = const(7)             # Position in chunk
+_XBM_LEN = const(8)             # No. of valid bytes in chunk
+_XBM_OUT = const(9)             # Bytes written to row buffer
+_XBM_ROWLEN = const(10)         # Row length in bytes
+_XBM_CHUNK = const(128)
+
+_XBM_MORE = const(0)            # _xbm_parse return values: chunk exhausted
+_XBM_ROW = const(1)             # Row buffer full
+_XBM_HEADER = const(2)          # Width and height parsed
+_XBM_END = const(3)             # Closing brace
+_XBM_BAD = const(4)             # Data before width and height
+
+@micropython.viper
+def _xbm_parse(chunk, row, state) -> int:
+    c = ptr8(chunk)
+    out = ptr8(row)
+    st = ptr32(state)
+    phase = st[_XBM_PHASE]
+    if phase == 4:
+        return _XBM_END
+    acc = st[_XBM_ACC]
+    intok = st[_XBM_INTOK]
+    num = st[_XBM_NUM]
+    pos = st[_XBM_POS]
+    n = st[_XBM_LEN]
+    o = st[_XBM_OUT]
+    rowlen = st[_XBM_ROWLEN]
+    result = _XBM_MORE
+    while pos < n:
+        ch = c[pos]
+        pos += 1
+        if phase == 3:                          # Hex data
+            if ch == 0x78 or ch == 0x58:        # x X
+                intok = 1
+                acc = 0
+            elif intok and ch >= 0x30 and ch <= 0x39:
+                acc = (acc << 4) + ch - 0x30
+            elif intok and ch >= 0x61 and ch <= 0x66:
+                acc = (acc << 4) + ch - 0x57
+            elif intok and ch >= 0x41 and ch <= 0x46:
+                acc = (acc << 4) + ch - 0x37
+            else:                               # Delimiter
+                if intok:
+                    out[o] = acc
+                    o += 1
+                    intok = 0
+                if ch == 0x7d:                  # }
+                    phase = 4
+                if o == rowlen:
+                    result = _XBM_ROW
+                    break
+                if phase == 4:
+                    result = _XBM_END
+                    break
+        elif phase == 1:                        # #define: keep last number
+            if ch >= 0x30 and ch <= 0x39:
+                num = num * 10 + ch - 0x30 if intok else ch - 0x30
+                intok = 1
+            else:
+                intok = 0
+                if ch == NEWLINE:
+                    phase = 0
+                    ndefs = st[_XBM_NDEFS]
+                    if ndefs < 2:
+                        st[_XBM_WIDTH + ndefs] = num
+                        st[_XBM_NDEFS] = ndefs + 1
+                        if ndefs == 1:
+                            result = _XBM_HEADER
+                            break
+        elif ch == 0x7b:                        # {
+            if st[_XBM_NDEFS] < 2:
+                result = _XBM_BAD
+                break
+            phase = 3
+            intok = 0
+        elif ch == NEWLINE:
+            phase = 0
+        elif phase == 0:
+            phase = 1 if ch == 0x23 else 2      # #
+    st[_XBM_PHASE] = phase
+    st[_XBM_ACC] = acc
+    st[_XBM_INTOK] = intok
+    st[_XBM_NUM] = num
+    st[_XBM_POS] = pos
+    st[_XBM_OUT] = o
+    return result
+
+# Generator parses an XBM file yielding (width, height) followed by each row.
+# The same row buffer is yielded each time: consume it before resuming.
+def xbm_rows(sourcefile):
+    state = array('i', (0 for _ in range(11)))
+    buf = bytearray(_XBM_CHUNK)
+    row = buf                                   # Unused until header is parsed
+    rows = 0
+    height = -1
+    with open(sourcefile, 'rb') as f:
+        while rows != height:
+            res = _xbm_parse(buf, row, state)
+            if res == _XBM_MORE:
+                state[_XBM_LEN] = f.readinto(buf)
+                state[_XBM_POS] = 0
+                if not state[_XBM_LEN]:
+                    break
+            elif res == _XBM_HEADER:
+                width = state[_XBM_WIDTH]
+                height = state[_XBM_WIDTH + 1]
+                row = bytearray((width + 7) >> 3)
+                state[_XBM_ROWLEN] = len(row)
+                yield width, height
+            elif res == _XBM_ROW:
+                state[_XBM_OUT] = 0
+                rows += 1
+                yield row
+            else:
+                break
+    if rows != height:
+        raise ImageFileError("File: '{}' is not a valid XBM file".format(sourcefile))
+
+
+# Binary image files comprise an 8 byte header followed by packed rows in the
+# display bit order (LSB leftmost), each row being (width + 7) // 8 bytes.
+# Header: 0x49, 0xe7, format, 0, width, height. Width and height are 16 bit
+# little endian.
+IMAGE_HEADER_LENGTH = const(8)
+IMAGE_RAW = const(0)                            # Image formats
+IMAGE_PACKBITS = const(1)                       # Compressed: see packbits.py
+
+class ImageFileError(Exception):
+    pass
+
+def image_header(width, height, fmt=IMAGE_RAW):
+    return bytes((0x49, 0xe7, fmt, 0, width & 0xff, width >> 8, height & 0xff, height >> 8))
+
+# Read and check a header, returning width, height, format
+def read_image_header(f, name):
+    header = f.read(IMAGE_HEADER_LENGTH)
+    if len(header) != IMAGE_HEADER_LENGTH or header[0] != 0x49 or header[1] != 0xe7:
+        raise ImageFileError('Image file {} is invalid'.format(name))
+    return header[4] | (header[5] << 8), header[6] | (header[7] << 8), header[2]
+
+# A sprite atlas file holds many small images (sprites) in one bitmap with an
+# index of named rectangles. Header: 0x41, 0xe7, count, width, height, all 16
+# bit little endian. Each index entry is a name of up to 12 bytes padded with
+# zeros followed by x, y, w, h (16 bit LE). Bitmap rows follow as for an
+# uncompressed image file.
+ATLAS_HEADER_LENGTH = const(8)
+ATLAS_NAME_LENGTH = const(12)
+ATLAS_ENTRY_LENGTH = const(20)
+
+atlases = {}                                    # Loaded atlases keyed by path
+
+class Atlas(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(ATLAS_HEADER_LENGTH)
+            if len(header) != ATLAS_HEADER_LENGTH or header[0] != 0x41 or header[1] != 0xe7:
+                raise ImageFileError('Atlas file {} is invalid'.format(path))
+            count = header[2] | (header[3] << 8)
+            self.width = header[4] | (header[5] << 8)
+            self.height = header[6] | (header[7] << 8)
+            self.stride = (self.width + 7) >> 3
+            self.sprites = {}                   # name: (x, y, w, h)
+            entry = bytearray(ATLAS_ENTRY_LENGTH)
+            for _ in range(count):
+                if f.readinto(entry) != ATLAS_ENTRY_LENGTH:
+                    raise ImageFileError('Atlas file {} is truncated'.format(path))
+                n = ATLAS_NAME_LENGTH
+                while n and not entry[n - 1]:
+                    n -= 1
+                e = ATLAS_NAME_LENGTH
+                self.sprites[bytes(entry[:n]).decode()] = (entry[e] | (entry[e + 1] << 8),
+                    entry[e + 2] | (entry[e + 3] << 8), entry[e + 4] | (entry[e + 5] << 8),
+                    entry[e + 6] | (entry[e + 7] << 8))
+            self.data = bytearray(self.stride * self.height)
+            if f.readinto(self.data) != len(self.data):
+                raise ImageFileError('Atlas file {} is truncated'.format(path))
+
+    def size(self, name):                       # Width and height of a sprite
+        return self.sprites[name][2:]
+
+# Convert an XBM file to a binary image file. XBM bit order matches the display.
+# Compression requires the whole image to be buffered.
+def convert_xbm(sourcefile, destfile, compress=False):
+    g = xbm_rows(sourcefile)
+    width, height = next(g)
+    stride = (width + 7) >> 3
+    with open(destfile, 'wb') as f:
+        f.write(image_header(width, height, IMAGE_PACKBITS if compress else IMAGE_RAW))
+        if compress:
+            from packbits import encode
+            buf = bytearray(stride * height)
+            mv = memoryview(buf)
+            for n, row in enumerate(g):
+                mv[n * stride : (n + 1) * stride] = row
+            f.write(encode(buf))
+        else:
+            for row in g:
+                f.write(row)
+
+# Frames saved by save_frame() are binary image files or P4 PBM files. PBM bit
+# order is MSB leftmost so bytes are reversed through a lookup table.
+FRAME_RAW = const(0)
+FRAME_PBM = const(1)
+
+_revtable = None
+
+def _reverse_table():                           # Bit reversal table built on first use
+    global _revtable
+    if _revtable is None:
+        _revtable = bytearray(256)
+        for n in range(256):
+            r = 0
+            for bit in range(8):
+                if n & (1 << bit):
+                    r |= 0x80 >> bit
+            _revtable[n] = r
+    return _revtable
+
+@micropython.viper
+def _bitrev(dst, src, table, n: int):          # May operate in place
+    d = ptr8(dst)
+    s = ptr8(src)
+    t = ptr8(table)
+    for i in range(n):
+        d[i] = t[s[i]]
+
+# Return the numeric fields of a PNM header: width, height and (if ntokens is 4)
+# maxval. Header lines must end with a newline.
+def _read_pnm_header(f, name, magic, ntokens):
+    tokens = []
+    while len(tokens) < ntokens:
+        line = f.readline()
+        if not line:
+            break
+        tokens.extend(line.split(b'#')[0].split())
+    if len(tokens) != ntokens or tokens[0] != magic:
+        raise ImageFileError('{} file {} is invalid'.format(magic.decode(), name))
+    return [int(t) for t in tokens[1:]]
+
+# 8x8 Bayer matrix as used by img_to_epd.py
+_BAYER = bytes((0, 32, 8, 40, 2, 34, 10, 42,
+                48, 16, 56, 24, 50, 18, 58, 26,
+                12, 44, 4, 36, 14, 46, 6, 38,
+                60, 28, 52, 20, 62, 30, 54, 22,
+                3, 35, 11, 43, 1, 33, 9, 41,
+                51, 19, 59, 27, 49, 17, 57, 25,
+                15, 47, 7, 39, 13, 45, 5, 37,
+                63, 31, 55, 23, 61, 29, 53, 21))
+
+# Ordered dither of a row of n grey levels. A pixel is black if below its
+# threshold: thresh holds 8 rows of 8 thresholds, row selects one of them.
+@micropython.viper
+def _dither(dst, src, thresh, n: int, row: int):
+    d = ptr8(dst)
+    s = ptr8(src)
+    t = ptr8(thresh)
+    row <<= 3                                   # Offset of threshold row
+    b = 0
+    x = 0
+    while x < n:
+        if s[x] < t[row + (x & 7)]:
+            b |= 1 << (x & 7)
+        x += 1
+        if not (x & 7):
+            d[(x >> 3) - 1] = b
+            b = 0
+    if n & 7:
+        d[n >> 3] = b
+
+# Bit aligned block transfer. Bitmaps are horizontally mapped with the LSB of
+# each byte leftmost. Args are destination and source buffers and an array of
+# parameters: dstride, sstride, sx, sy, dx, dy, w, h, op. Clipping is done by the
+# caller: the w * h rectangle must lie within both bitmaps.
+@micropython.viper
+def _blit(dst, src, params):
+    d = ptr8(dst)
+    s = ptr8(src)
+    p = ptr32(params)
+    dstride = p[0]
+    sstride = p[1]
+    sx = p[2]
+    dx = p[4]
+    w = p[6]
+    op = p[8]
+    send = sx + w                               # Source bit after last copied
+    first = dx >> 3                             # Destination byte range
+    last = (dx + w - 1) >> 3
+    fmask = (0xff << (dx & 7)) & 0xff           # Edge masks
+    lmask = 0xff >> (7 - ((dx + w - 1) & 7))
+    srow = p[3] * sstride
+    drow = p[5] * dstride
+    for row in range(p[7]):
+        for db in range(first, last + 1):
+            mask = 0xff
+            if db == first:
+                mask = fmask
+            if db == last:
+                mask &= lmask
+            sb = (db << 3) - dx + sx + 8        # Source bit + 8: never negative
+            k = (sb >> 3) - 1                   # Source byte
+            v = 0
+            if k >= 0:
+                v = s[srow + k]
+            if ((k + 1) << 3) < send:
+                v |= s[srow + k + 1] << 8
+            v = (v >> (sb & 7)) & 0xff
+            i = drow + db
+            if op == 0:                         # COPY
+                d[i] = (d[i] & (mask ^ 0xff)) | (v & mask)
+            elif op == 1:                       # OR
+                d[i] |= v & mask
+            elif op == 2:                       # AND
+                d[i] &= v | (mask ^ 0xff)
+            elif op == 3:                       # XOR
+                d[i] ^= v & mask
+            else:                               # NOT
+                d[i] = (d[i] & (mask ^ 0xff)) | ((v ^ 0xff) & mask)
+        srow += sstride
+        drow += dstride
+
+# Plot points from two array('h') instances of x and y coordinates. params:
+# dstride, n, cx0, cy0, cx1, cy1, ox, oy, black. Points are clipped to cx0..cx1-1
+# and cy0..cy1-1.
+@micropython.viper
+def _plot(dst, xs, ys, params):
+    d = ptr8(dst)
+    px = ptr16(xs)
+    py = ptr16(ys)
+    p = ptr32(params)
+    dstride = p[0]
+    cx0 = p[2]
+    cy0 = p[3]
+    cx1 = p[4]
+    cy1 = p[5]
+    ox = p[6]
+    oy = p[7]
+    black = p[8]
+    for i in range(p[1]):
+        x = px[i]
+        y = py[i]
+        if x & 0x8000:                          # Sign extend
+            x -= 0x10000
+        if y & 0x8000:
+            y -= 0x10000
+        x += ox
+        y += oy
+        if x >= cx0 and x < cx1 and y >= cy0 and y < cy1:
+            j = y * dstride + (x >> 3)
+            m = 1 << (x & 7)
+            if black:
+                d[j] |= m
+            else:
+                d[j] &= m ^ 0xff
+
+# Plot an array('h') of y values. params: dstride, n, cx0, cy0, cx1, cy1, x0,
+# y0, xscale, yscale, ymin, black, join. x0, y0 are absolute, scales are fixed
+# point with 12 fractional bits. If join is set successive points are joined by
+# a vertical run of pixels.
+@micropython.viper
+def _series(dst, data, params):
+    d = ptr8(dst)
+    pd = ptr16(data)
+    p = ptr32(params)
+    dstride = p[0]
+    cx0 = p[2]
+    cy0 = p[3]
+    cx1 = p[4]
+    cy1 = p[5]
+    x0 = p[6]
+    y0 = p[7]
+    xscale = p[8]
+    yscale = p[9]
+    ymin = p[10]
+    black = p[11]
+    join = p[12]
+    yprev = 0
+    for i in range(p[1]):
+        v = pd[i]
+        if v & 0x8000:
+            v -= 0x10000
+        x = x0 + ((i * xscale) >> 12)
+        y = y0 - (((v - ymin) * yscale) >> 12)
+        ya = y
+        yb = y
+        if join and i:                          # Vertical run from previous point
+            if yprev < y:
+                ya = yprev
+            else:
+                yb = yprev
+        yprev = y
+        if x >= cx0 and x < cx1:
+            if ya < cy0:
+                ya = cy0
+            if yb >= cy1:
+                yb = cy1 - 1
+            m = 1 << (x & 7)
+            j = ya * dstride + (x >> 3)
+            while ya <= yb:
+                if black:
+                    d[j] |= m
+                else:
+                    d[j] &= m ^ 0xff
+                j += dstride
+                ya += 1
+
+# Byte expansion tables for scaled text, built on first use. Entry b of the
+# table for scale n is n bytes holding each bit of b repeated n times.
+_expansions = {}
+
+def _expansion(scale):
+    table = _expansions.get(scale)
+    if table is None:
+        table = bytearray(256 * scale)
+        ones = (1 << scale) - 1
+        for n in range(256):
+            v = 0
+            for bit in range(8):
+                if n & (1 << bit):
+                    v |= ones << (bit * scale)
+            for k in range(scale):
+                table[n * scale + k] = (v >> (k << 3)) & 0xff
+        _expansions[scale] = table
+    return table
+
+# Magnify a glyph by an integer factor. params: source stride, source start,
+# height, scale. Each source row is expanded by table lookup then repeated.
+@micropython.viper
+def _expand(dst, src, table, params):
+    d = ptr8(dst)
+    s = ptr8(src)
+    t = ptr8(table)
+    p = ptr32(params)
+    sstride = p[0]
+    si = p[1]
+    h = p[2]
+    scale = p[3]
+    dstride = sstride * scale
+    di = 0
+    for row in range(h):
+        start = di
+        for n in range(sstride):
+            ti = s[si + n] * scale
+            for k in range(scale):
+                d[di] = t[ti + k]
+                di += 1
+        for r in range(1, scale):
+            for n in range(dstride):
+                d[di] = d[start + n]
+                di += 1
+        si += sstride
+
+# Transpose a vertically mapped glyph (columns of (height + 7) // 8 bytes, LSB
+# or if msb is set MSB at the top) to rows of (width + 7) // 8 bytes, LSB
+# leftmost. params: width, height, msb, destination start.
+@micropython.viper
+def _transpose(dst, src, params):
+    d = ptr8(dst)
+    s = ptr8(src)
+    p = ptr32(params)
+    w = p[0]
+    h = p[1]
+    msb = p[2]
+    di = p[3]
+    vb = (h + 7) >> 3
+    hb = (w + 7) >> 3
+    for n in range(hb * h):
+        d[di + n] = 0
+    si = 0
+    for x in range(w):
+        mask = 1 << (x & 7)
+        col = di + (x >> 3)
+        for yb in range(vb):
+            b = s[si]
+            si += 1
+            y = yb << 3
+            for k in range(8):
+                if y + k < h:
+                    if msb:
+                        bit = (b >> (7 - k)) & 1
+                    else:
+                        bit = (b >> k) & 1
+                    if bit:
+                        d[col + (y + k) * hb] = d[col + (y + k) * hb] | mask
+
+# Draw a glyph whose rows are sstride bytes starting at byte si of src, with
+# its top left at x, y. The glyph must lie within the destination. A byte aligned
+# glyph is copied, otherwise bytes are shifted and merged with the destination at
+# each end of the row. params: dstride, sstride, si, x, y, h.
+@micropython.viper
+def _glyph(dst, src, params):
+    d = ptr8(dst)
+    s = ptr8(src)
+    p = ptr32(params)
+    dstride = p[0]
+    sstride = p[1]
+    si = p[2]
+    x = p[3]
+    h = p[5]
+    di = p[4] * dstride + (x >> 3)
+    shift = x & 7
+    if shift == 0:
+        for _ in range(h):
+            for k in range(sstride):
+                d[di + k] = s[si + k]
+            di += dstride
+            si += sstride
+    else:
+        rshift = 8 - shift
+        lmask = (1 << shift) - 1                # Destination bits left of glyph
+        for _ in range(h):
+            carry = d[di] & lmask
+            for k in range(sstride):
+                b = s[si + k]
+                d[di + k] = carry | ((b << shift) & 0xff)
+                carry = b >> rshift
+            d[di + sstride] = (d[di + sstride] & (0xff ^ lmask)) | carry
+            di += dstride
+            si += sstride
+
+# Scaling kernels. Source and destination are packed rows. params: output width,
+# source pixels per output pixel (12 bit fixed point) and, for _box_emit, the
+# number of source rows accumulated.
+@micropython.viper
+def _scale_nearest(dst, src, params):
+    d = ptr8(dst)
+    s = ptr8(src)
+    p = ptr32(params)
+    ow = p[0]
+    step = p[1]
+    pos = step >> 1                             # Centre of output pixel
+    b = 0
+    ox = 0
+    while ox < ow:
+        sx = pos >> 12
+        if s[sx >> 3] & (1 << (sx & 7)):
+            b |= 1 << (ox & 7)
+        pos += step
+        ox += 1
+        if not (ox & 7):
+            d[(ox >> 3) - 1] = b
+            b = 0
+    if ow & 7:
+        d[ow >> 3] = b
+
+@micropython.viper
+def _box_add(acc, src, params):                 # Add black pixel counts per box
+    a = ptr16(acc)
+    s = ptr8(src)
+    p = ptr32(params)
+    ow = p[0]
+    step = p[1]
+    sx = 0
+    ox = 0
+    while ox < ow:
+        end = ((ox + 1) * step) >> 12
+        n = 0
+        while sx < end:
+            if s[sx >> 3] & (1 << (sx & 7)):
+                n += 1
+            sx += 1
+        a[ox] += n
+        ox += 1
+
+@micropython.viper
+def _box_emit(dst, acc, params):                # Black if half or more of box is black
+    d = ptr8(dst)
+    a = ptr16(acc)
+    p = ptr32(params)
+    ow = p[0]
+    step = p[1]
+    rows = p[2]
+    sx = 0
+    b = 0
+    ox = 0
+    while ox < ow:
+        end = ((ox + 1) * step) >> 12
+        if a[ox] * 2 >= (end - sx) * rows:
+            b |= 1 << (ox & 7)
+        a[ox] = 0
+        sx = end
+        ox += 1
+        if not (ox & 7):
+            d[(ox >> 3) - 1] = b
+            b = 0
+    if ow & 7:
+        d[ow >> 3] = b
+
+# Scale a stream of source rows passed to feed(), drawing output rows to a
+# Graphics instance. Nearest neighbour sampling or, for scale <= 1, a box filter.
+class _Scaler(object):
+    def __init__(self, gfx, width, height, x, y, scale, box):
+        if scale <= 0 or (box and scale > 1):
+            raise ValueError('Invalid scale {}'.format(scale))
+        self.gfx = gfx
+        self.x = x
+        self.y = y
+        self.ow = max(1, int(width * scale))   # Output dimensions
+        self.oh = max(1, int(height * scale))
+        self.ystep = (height << 12) // self.oh
+        self.params = array('i', (self.ow, (width << 12) // self.ow, 0))
+        self.buf = bytearray((self.ow + 7) >> 3)
+        self.acc = array('H', (0 for _ in range(self.ow))) if box else None
+        self.row = 0                            # Source row
+        self.orow = 0                           # Output row
+
+    def feed(self, src):
+        row = self.row
+        self.row += 1
+        ystep = self.ystep
+        orow = self.orow
+        if orow >= self.oh:
+            return
+        if self.acc is None:                    # Nearest: emit rows sampling this one
+            if ((orow * ystep + (ystep >> 1)) >> 12) == row:
+                _scale_nearest(self.buf, src, self.params)
+                while orow < self.oh and ((orow * ystep + (ystep >> 1)) >> 12) == row:
+                    self.gfx.blit(self.buf, self.ow, 1, self.x, self.y + orow)
+                    orow += 1
+        else:
+            _box_add(self.acc, src, self.params)
+            end = ((orow + 1) * ystep) >> 12    # First source row of next output row
+            if row + 1 >= end:
+                self.params[2] = end - ((orow * ystep) >> 12)
+                _box_emit(self.buf, self.acc, self.params)
+                self.gfx.blit(self.buf, self.ow, 1, self.x, self.y + orow)
+                orow += 1
+        self.orow = orow
 
 class FontFileError(Exception):
     pass
 
+# Binary font files. Version 1: 0x42, 0xe7, max width, height followed by
+# characters 32-126 each stored at the maximum width, preceded by a width byte.
+# Version 2: 0x42, 0xe8, max width, height, flags, 0, first character, count
+# (16 bit LE), then count + 1 32 bit LE offsets of glyphs relative to the end of
+# the table. Each glyph is a width byte and rows of (width + 7) // 8 bytes.
+# If flags has FONT_SPARSE set the characters need not be contiguous: a table
+# of count sorted 16 bit LE character codes precedes the offsets and first is 0.
+FONT_V2_HEADER_LENGTH = const(10)
+FONT_SPARSE = const(1)
+
 class Font(object):
-    def __init__(self):
+    def __init__(self, cache_size = 12):
+        self.cache_size = cache_size # Glyph cache for binary fonts
+        self.cache_name = None  # Font file whose glyphs are cached
+        self.glyphs = []        # Preallocated buffers: width byte then bitmap
+        self.slots = {}         # Glyph index: index into glyphs
+        self.keys = []          # Glyph index held in each slot
+        self.stamps = []        # LRU time stamp of each slot
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
         self.bytes_per_ch = 0   # Number of bytes to define a character
         self.bytes_horiz = 0    # No. of bytes per character row
         self.bits_horiz = 0     # Horzontal bits in character matrix
@@ -85,12 +796,27 @@ class Font(object):
         self.monospaced = False # Default is variable width
         self.exists = False
         self.modfont = None
+        self.converted = False  # Python font not hmap reversed: glyphs converted into cache
+        self.vertical = False   # Python font is vertically mapped
+        self.msb_first = False  # Python font bit order is MSB first (leftmost or top)
+        self.params = array('i', (0, 0, 0, 1)) # Transpose kernel args
         self.fontfilename = None
         self.fontfile = None
+        self.indexed = False    # Version 2 binary font
+        self.offsets = None     # Glyph offset table of version 2 font
+        self.data_start = 0     # File offset of glyph data
+        self.first = 32         # Range of characters in binary font
+        self.count = 95         # Number of glyphs
+        self.charcodes = None   # Sorted character codes of a sparse font
+        self.ascii = None       # Sparse font: glyph index of codes 0-127
+        self.default = 0        # Glyph index of '?': used for missing characters
+        self.persistent = False # Registered font: remains open
+        self.advances = None    # Advance widths in glyph index order
+        self.adv_source = None  # Font whose advances are held
 
-    # monospaced only applies to binary files. Since these lack an index FIXME
+    # monospaced only applies to binary files. Version 1 files lack an index so
     # characters are saved in fixed pitch with width data, hence can be
-    # rendered as fixed or variable pitch.
+    # rendered as fixed or variable pitch. Version 2 files are indexed.
     # Python fonts are saved as variable or fixed pitch depending on the -f arg.
     # The monospaced flag saved with the file enables the renderer to
     # determine the correct x advance.
@@ -100,170 +826,301 @@ class Font(object):
         return self
 
     def __enter__(self): #fopen(self, fontfile):
+        if self.persistent:                     # Registered: already open
+            return self
         if isinstance(self.fontfilename, type(uos)):  # Using a Python font
             self.fontfile = None
             f = self.fontfilename
-            ok = False
             try:
-                ok = f.hmap() and f.reverse()
+                self.vertical = not f.hmap()
+                rev = f.reverse()
             except AttributeError:
-                pass
-            if not ok:
                 raise FontFileError('Font module {} is invalid'.format(f.__name__))
+            self.msb_first = rev if self.vertical else not rev
+            self.converted = self.vertical or self.msb_first
             self.monospaced = f.monospaced()
             self.modfont = f
             self.bits_horiz = f.max_width()
             self.bits_vert = f.height()
         else:
             self.modfont = None
+            self.converted = self.vertical = self.msb_first = False
             try:
                 f = open(self.fontfilename, 'rb')
             except OSError as err:
                 raise FontFileError(err)
             self.fontfile = f
             header = f.read(4)
-            if header[0] == 0x42 and header[1] == 0xe7:
+            if len(header) == 4 and header[0] == 0x42 and header[1] in (0xe7, 0xe8):
                 self.bits_horiz = header[2] # font[1]
                 self.bits_vert = header[3] # font[2]
             else:
                 raise FontFileError('Font file {} is invalid'.format(self.fontfilename))
+            self.indexed = header[1] == 0xe8
+            flags = 0
+            if self.indexed:
+                header = f.read(FONT_V2_HEADER_LENGTH - 4)
+                flags = header[0]
+                self.first = header[2] | (header[3] << 8)
+                self.count = header[4] | (header[5] << 8)
+            else:
+                self.first = 32
+                self.count = 95
+            if self.fontfilename != self.cache_name: # Read tables once
+                self.charcodes = None
+                if flags & FONT_SPARSE:
+                    self.charcodes = array('H', (0 for _ in range(self.count)))
+                    f.readinto(self.charcodes)
+                if self.indexed:
+                    self.offsets = array('I', (0 for _ in range(self.count + 1)))
+                    f.readinto(self.offsets)
+                self.data_start = f.tell()
+                self._build_index()
         self.bytes_horiz = (self.bits_horiz + 7) // 8
         self.bytes_per_ch = self.bytes_horiz * self.bits_vert
+        if (self.fontfile is not None or self.converted) and self.fontfilename != self.cache_name:
+            self._init_cache()                  # Cache persists while font is unchanged
         self.exists = True
         return self
 
-    def __exit__(self, *_):
-        self.exists = False
-        if self.fontfile is not None:
-            self.fontfile.close()
+    def _init_cache(self):
+        self.glyphs = []                        # Free old buffers before allocating
+        gc.collect()
+        self.glyphs = [bytearray(self.bytes_per_ch + 1) for _ in range(self.cache_size)]
+        self.slots = {}
+        self.keys = [-1] * self.cache_size
+        self.stamps = [0] * self.cache_size
+        self.cache_name = self.fontfilename
 
-class Display(object):
-    FONT_HEADER_LENGTH = 4
-    def __init__(self, side='L',*, mode=NORMAL, model=EMBEDDED_ARTISTS, use_flash=False, up_time=None):
-        self.flash = None                       # Assume flash is unused
-        self.in_context = False
-        try:
-            intside = {'l':0, 'r':1}[side.lower()]
-        except (KeyError, AttributeError):
-            raise ValueError("Side must be 'L' or 'R'")
-        if model not in (EMBEDDED_ARTISTS, ADAFRUIT):
-            raise ValueError('Unsupported model')
-        if mode == FAST and use_flash:
-            raise ValueError('Flash memory unavailable in fast mode')
-        if mode == NORMAL and up_time is not None:
-            raise ValueError('Cannot set up_time in normal mode')
-        if mode == NORMAL:
-            from epd import EPD
-            self.epd = EPD(intside, model)
-        elif mode == FAST:
-            from epdpart import EPD
-            self.epd = EPD(intside, model, up_time)
+# A sparse font has a direct table for ASCII codes, others being found by
+# binary search of the sorted codes. Missing characters map to '?' if present.
+    def _build_index(self):
+        self.default = 0
+        codes = self.charcodes
+        if codes is None:
+            self.ascii = None
+            if self.first <= 63 < self.first + self.count:
+                self.default = 63 - self.first
+            return
+        for n in range(self.count):
+            if codes[n] == 63:
+                self.default = n
+        self.ascii = array('H', (self.default for _ in range(128)))
+        for n in range(self.count):
+            if codes[n] < 128:
+                self.ascii[codes[n]] = n
+
+# Return the glyph index of character code c in a binary font.
+    def index(self, c):
+        codes = self.charcodes
+        if codes is None:                       # Contiguous range
+            n = c - self.first
+            return n if n >= 0 and n < self.count else self.default
+        if c < 128:                             # O(1) for ASCII
+            return self.ascii[c]
+        lo = 0
+        hi = self.count - 1
+        while lo <= hi:
+            mid = (lo + hi) >> 1
+            code = codes[mid]
+            if code == c:
+                return mid
+            if code < c:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        return self.default
+
+# Return the x advance of character code c. The advance widths of a font are
+# read once into a bytearray. Font modules hold those of characters 32-126.
+    def advance(self, c):
+        if self.monospaced:
+            return self.bits_horiz
+        if self.adv_source != self.fontfilename:
+            self._read_advances()
+        if self.modfont is None:
+            return self.advances[self.index(c)]
+        n = c - 32
+        if n >= 0 and n < 95:
+            return self.advances[n]
+        return self.modfont.get_ch(chr(c))[2]
+
+    def _read_advances(self):
+        if self.modfont is not None:
+            self.advances = bytearray(95)
+            for n in range(95):
+                self.advances[n] = self.modfont.get_ch(chr(n + 32))[2]
         else:
-            raise ValueError('Unsupported mode {}'.format(mode))
-        self.mode = mode
-        self.font = Font()
-        gc.collect()
-        self.locate(0, 0)                       # Text cursor: default top left
+            self.advances = bytearray(self.count)
+            ff = self.fontfile
+            for n in range(self.count):
+                if self.indexed:
+                    ff.seek(self.data_start + self.offsets[n])
+                else:
+                    ff.seek(self.data_start + n * (self.bytes_per_ch + 1))
+                self.advances[n] = ff.read(1)[0]
+        self.adv_source = self.fontfilename
 
-        self.mounted = False                    # umountflash() not to sync
-        if use_flash:
-            from flash import FlashClass
-            gc.collect()
-            self.flash = FlashClass(intside)
-            self.umountflash()                  # In case mounted by prior tests.
-            self.mountflash()
-        gc.collect()
+# Binary or converted Python font: return a buffer holding the width of
+# character c followed by its bitmap. Recently used glyphs are cached, the least
+# recently used being replaced. Characters not in the font are rendered as '?'.
+    def glyph(self, c):
+        self.tick += 1
+        if self.modfont is None:
+            c = self.index(c)
+        slot = self.slots.get(c)
+        if slot is None:
+            self.misses += 1
+            stamps = self.stamps
+            slot = 0
+            for n in range(1, len(stamps)):
+                if stamps[n] < stamps[slot]:
+                    slot = n
+            if self.keys[slot] >= 0:
+                del self.slots[self.keys[slot]]
+            ff = self.fontfile
+            if self.modfont is not None:
+                self._convert(c, self.glyphs[slot])
+            elif ff is None:
+                raise FontFileError('Font file {} is closed'.format(self.fontfilename))
+            elif self.indexed:                  # Read only the bytes of the glyph
+                offsets = self.offsets
+                start = offsets[c]
+                ff.seek(self.data_start + start)
+                ff.readinto(memoryview(self.glyphs[slot])[: offsets[c + 1] - start])
+            else:
+                ff.seek(self.data_start + c * (self.bytes_per_ch + 1))
+                ff.readinto(self.glyphs[slot])
+            self.slots[c] = slot
+            self.keys[slot] = c
+        else:
+            self.hits += 1
+        self.stamps[slot] = self.tick
+        return self.glyphs[slot]
 
-    def checkcm(self):
-        if not (self.mode == NORMAL or self.in_context):
-            raise EPDError('Fast mode must be run using a context manager')
+# Convert a glyph of a Python font to rows, LSB leftmost, preceded by its width.
+    def _convert(self, c, buf):
+        mv, height, width = self.modfont.get_ch(chr(c))
+        buf[0] = width
+        if self.vertical:
+            p = self.params
+            p[0] = width
+            p[1] = height
+            p[2] = self.msb_first
+            _transpose(buf, mv, p)
+        else:
+            _bitrev(memoryview(buf)[1:], mv, _reverse_table(), ((width + 7) >> 3) * height)
 
-    def __enter__(self):                        # Power up
-        checkstate(self.mode == FAST, "In normal mode, can't use context manager")
-        self.in_context = True
-        self.epd.enter()
-        return self
+# A registered font file is closed while the flash device is unmounted and
+# reopened when it is mounted. Tables and cached glyphs are retained.
+    def suspend(self):
+        if self.fontfile is not None:
+            self.fontfile.close()
+            self.fontfile = None
 
-    def __exit__(self, *_):                     # shut down
-        self.in_context = False
-        self.epd.exit()
-        pass
+    def resume(self):
+        if self.fontfile is None and self.modfont is None:
+            try:
+                self.fontfile = open(self.fontfilename, 'rb')
+            except OSError as err:
+                raise FontFileError(err)
 
-    def mountflash(self):
-        if self.flash is None:                  # Not being used
+    def __exit__(self, *_):
+        if self.persistent:
             return
-        self.flash.begin()                      # Initialise.
-        vfs = uos.VfsFat(self.flash)  # Instantiate FAT filesystem
-        uos.mount(vfs, self.flash.mountpoint)
-        self.mounted = True
+        self.exists = False
+        if self.fontfile is not None:
+            self.fontfile.close()
 
-    def umountflash(self):                      # Unmount flash
-        if self.flash is None:
-            return
-        if self.mounted:
-            self.flash.synchronise()
-        try:
-            uos.umount(self.flash.mountpoint)
-        except OSError:
-            pass                                # Don't care if it wasn't mounted
-        self.flash.end()                        # Shut down
-        self.mounted = False                    # flag unmounted to prevent spurious syncs
+# Drawing primitives and text rendering common to the display and to off
+# screen canvases. Subclasses provide the buffer as self.image.
+class Graphics(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.bpl = (width + 7) >> 3             # Bytes per line
+        self.default_font = Font()              # Used for unregistered fonts
+        self.current_font = self.default_font
+        self.fonts = {}                         # Registered fonts
+        self.params = array('i', [0] * 13)      # Viper kernel args: avoid allocation
+        self.fbufs = []                         # (buffer, FrameBuffer) pairs
+        self.clips = []                         # Clip stack
+        self.ox = 0                             # Origin offset
+        self.oy = 0
+        self.cx0 = 0                            # Clip region (absolute, exclusive of cx1, cy1)
+        self.cy0 = 0
+        self.cx1 = width
+        self.cy1 = height
+        self.vcanvas = None                     # Most recent viewport() source
+        self.cur_atlas = None                   # Atlas used by sprite()
+        self.image_cache = None                 # Default cache for load_cached()
+        self.text_cache = None                  # Optional TextCache used by puts()
+        self.scale_buf = None                   # Magnified glyph for scaled text
+        self.locate(0, 0)                       # Text cursor: default top left
 
-    def show(self):
-        self.checkcm()
-        self.umountflash()                      # sync, umount flash, shut it down and disable SPI
-        if self.mode == NORMAL:                 # EPD functions which access the display electronics must be
-            with self.epd as epd:               # called from a with block to ensure proper startup & shutdown
-                epd.showdata()
-        else:                                   # Fast mode: already in context manager
-            self.epd.showdata()
-        self.mountflash()
+    @property
+    def location(self):
+        return self.char_x, self.char_y
 
-    def clear_screen(self, show=True, both=False):
-        self.checkcm()
-        self.locate(0, 0)                       # Reset text cursor
-        self.epd.clear_data(both)
-        if show:
-            if self.mode == NORMAL:
-                self.show()
-            else:
-                self.epd.EPD_clear()
+    @property
+    def framebuffer(self):                      # FrameBuffer for the current buffer or None
+        if framebuf is None:
+            return None
+        image = self.image
+        for buf, fb in self.fbufs:
+            if buf is image:
+                return fb
+        fb = framebuf.FrameBuffer(image, self.width, self.height, framebuf.MONO_HMSB)
+        self.fbufs.append((image, fb))
+        return fb
 
-    def refresh(self, fast =True):              # Fast mode only functions
-        checkstate(self.mode == FAST, 'refresh() invalid in normal mode')
-        self.checkcm()
-        self.epd.refresh(fast)
+# ****** Clipping ******
+# Graphics and text are clipped to the current clip region. Coordinates passed
+# to drawing methods are relative to the current origin.
 
-    def exchange(self, clear_data):
-        checkstate(self.mode == FAST, 'exchange() invalid in normal mode')
-        self.checkcm()
-        self.epd.exchange(clear_data)
+    def push_clip(self, x0, y0, x1, y1, origin=False): # Corners are inclusive
+        self.clips.append((self.cx0, self.cy0, self.cx1, self.cy1, self.ox, self.oy))
+        x0, x1 = (x0, x1) if x1 > x0 else (x1, x0)
+        y0, y1 = (y0, y1) if y1 > y0 else (y1, y0)
+        x0 += self.ox
+        y0 += self.oy
+        self.cx0 = max(self.cx0, x0)            # Intersect with current region
+        self.cy0 = max(self.cy0, y0)
+        self.cx1 = max(self.cx0, min(self.cx1, x1 + self.ox + 1))
+        self.cy1 = max(self.cy0, min(self.cy1, y1 + self.oy + 1))
+        if origin:                              # Coordinates become relative to x0, y0
+            self.ox = x0
+            self.oy = y0
 
-    @property
-    def temperature(self):                      # return temperature as integer in Celsius
-        return self.epd.temperature
+    def pop_clip(self):
+        checkstate(self.clips, 'Clip stack is empty')
+        self.cx0, self.cy0, self.cx1, self.cy1, self.ox, self.oy = self.clips.pop()
 
     @property
-    def location(self):
-        return self.char_x, self.char_y
+    def clip(self):                             # Current clip region in local coordinates
+        ox = self.ox
+        oy = self.oy
+        return self.cx0 - ox, self.cy0 - oy, self.cx1 - ox - 1, self.cy1 - oy - 1
 
     @micropython.native
-    def setpixel(self, x, y, black):            # 41uS. Clips to borders. x, y must be integer
-        if y < 0 or y >= LINES_PER_DISPLAY or x < 0 or x >= BITS_PER_LINE :
+    def setpixel(self, x, y, black):            # 41uS. Clips to region. x, y must be integer
+        x += self.ox
+        y += self.oy
+        if y < self.cy0 or y >= self.cy1 or x < self.cx0 or x >= self.cx1:
             return
-        image = self.epd.image
+        image = self.image
         omask = 1 << (x & 0x07)
-        index = (x >> 3) + y *BYTES_PER_LINE
+        index = (x >> 3) + y * self.bpl
         if black:
             image[index] |= omask
         else:
             image[index] &= (omask ^ 0xff)
 
     @micropython.viper
-    def setpixelfast(self, x: int, y: int, black: int): # 27uS. Caller checks bounds
-        image = ptr8(self.epd.image)
+    def setpixelfast(self, x: int, y: int, black: int): # 27uS. Absolute coords: caller checks bounds
+        image = ptr8(self.image)
         omask = 1 << (x & 0x07)
-        index = (x >> 3) + y * 33 #BYTES_PER_LINE
+        index = (x >> 3) + y * int(self.bpl)
         if black:
             image[index] |= omask
         else:
@@ -271,7 +1128,27 @@ class Display(object):
 
 # ****** Simple graphics support ******
 
+# Lines partly outside the clip region are drawn from the first step within it
+# with the Bresenham state of the unclipped line, so that clipping does not move
+# pixels.
     def _line(self, x0, y0, x1, y1, black = True): # Sinle pixel line
+        x0 += self.ox                           # Absolute
+        y0 += self.oy
+        x1 += self.ox
+        y1 += self.oy
+        xmin = self.cx0
+        ymin = self.cy0
+        xmax = self.cx1 - 1
+        ymax = self.cy1 - 1
+        c0 = _outcode(x0, y0, xmin, ymin, xmax, ymax)
+        c1 = _outcode(x1, y1, xmin, ymin, xmax, ymax)
+        if c0 & c1:                             # Both ends outside on the same side
+            return
+        fb = self.framebuffer
+        if fb is not None and not (c0 | c1):    # Both ends inside
+            fb.line(x0, y0, x1, y1, black)
+            return
+        setpixel = self.setpixelfast            # Clipped: no need to check bounds
         dx = x1 -x0
         dy = y1 -y0
         dx_sym = 1 if dx > 0 else -1
@@ -282,27 +1159,41 @@ class Display(object):
         dx_x2 = dx*2
         dy_x2 = dy*2
         if (dx >= dy):
-            di = dy_x2 - dx
-            while (x0 != x1):
-                self.setpixel(x0, y0, black)
+            span = _clipspan(x0, dx_sym, dx, xmin, xmax, y0, dy_sym, dy, ymin, ymax)
+            if span is None:
+                return
+            k, n = span
+            m = (dy_x2 * k + dx) // dx_x2 if dx else 0
+            x0 += dx_sym * k
+            y0 += dy_sym * m
+            di = dy_x2 * (k + 1) - dx - dx_x2 * m
+            for _ in range(n - k):
+                setpixel(x0, y0, black)
                 x0 += dx_sym
                 if (di<0):
                     di += dy_x2
                 else :
                     di += dy_x2 - dx_x2
                     y0 += dy_sym
-            self.setpixel(x0, y0, black)
+            setpixel(x0, y0, black)
         else:
-            di = dx_x2 - dy
-            while (y0 != y1):
-                self.setpixel(x0, y0, black)
+            span = _clipspan(y0, dy_sym, dy, ymin, ymax, x0, dx_sym, dx, xmin, xmax)
+            if span is None:
+                return
+            k, n = span
+            m = (dx_x2 * k + dy) // dy_x2
+            y0 += dy_sym * k
+            x0 += dx_sym * m
+            di = dx_x2 * (k + 1) - dy - dy_x2 * m
+            for _ in range(n - k):
+                setpixel(x0, y0, black)
                 y0 += dy_sym
                 if (di < 0):
                     di += dx_x2
                 else:
                     di += dx_x2 - dy_x2
                     x0 += dx_sym
-            self.setpixel(x0, y0, black)
+            setpixel(x0, y0, black)
 
     def line(self, x0, y0, x1, y1, width =1, black = True): # Draw line
         x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
@@ -330,19 +1221,38 @@ class Display(object):
         x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
         x0, x1 = (x0, x1) if x1 > x0 else (x1, x0)
         y0, y1 = (y0, y1) if y1 > y0 else (y1, y0)
+        x0 = max(x0 + self.ox, self.cx0)        # Clip spans
+        x1 = min(x1 + self.ox, self.cx1)
+        y0 = max(y0 + self.oy, self.cy0)
+        y1 = min(y1 + self.oy, self.cy1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        fb = self.framebuffer
+        if fb is not None:
+            fb.fill_rect(x0, y0, x1 - x0, y1 - y0, black)
+            return
+        setpixel = self.setpixelfast
         for x in range(x0, x1):
             for y in range(y0, y1):
-                self.setpixel(x, y, black)
+                setpixel(x, y, black)
 
     def _circle(self, x0, y0, r, black = True): # Single pixel circle
+        xa = x0 + self.ox                       # Absolute centre
+        ya = y0 + self.oy
+        if xa - r >= self.cx0 and xa + r < self.cx1 and ya - r >= self.cy0 and ya + r < self.cy1:
+            setpixel = self.setpixelfast        # Entirely within clip region
+            x0 = xa
+            y0 = ya
+        else:
+            setpixel = self.setpixel
         x = -r
         y = 0
         err = 2 -2*r
         while x <= 0:
-            self.setpixel(x0 -x, y0 +y, black)
-            self.setpixel(x0 +x, y0 +y, black)
-            self.setpixel(x0 +x, y0 -y, black)
-            self.setpixel(x0 -x, y0 -y, black)
+            setpixel(x0 -x, y0 +y, black)
+            setpixel(x0 +x, y0 +y, black)
+            setpixel(x0 +x, y0 -y, black)
+            setpixel(x0 -x, y0 -y, black)
             e2 = err
             if (e2 <= y):
                 y += 1
@@ -376,54 +1286,341 @@ class Display(object):
                 x += 1
                 err += x*2 +1
 
+# Batch plotting. Coordinates and data are array('h') instances.
+
+    def plot_points(self, xs, ys, black = True):
+        p = self.params
+        p[0] = self.bpl
+        p[1] = min(len(xs), len(ys))
+        p[2] = self.cx0
+        p[3] = self.cy0
+        p[4] = self.cx1
+        p[5] = self.cy1
+        p[6] = self.ox
+        p[7] = self.oy
+        p[8] = 1 if black else 0
+        _plot(self.image, xs, ys, p)
+
+# Point n is plotted at x0 + n * xscale, y0 - (data[n] - ymin) * yscale
+    def plot_series(self, data, x0, y0, xscale = 1, yscale = 1, *, ymin = 0, black = True, join = False):
+        p = self.params
+        p[0] = self.bpl
+        p[1] = len(data)
+        p[2] = self.cx0
+        p[3] = self.cy0
+        p[4] = self.cx1
+        p[5] = self.cy1
+        p[6] = int(x0) + self.ox
+        p[7] = int(y0) + self.oy
+        p[8] = int(xscale * 4096)
+        p[9] = int(yscale * 4096)
+        p[10] = ymin
+        p[11] = 1 if black else 0
+        p[12] = 1 if join else 0
+        _series(self.image, data, p)
+
+# Native text and scrolling: these require the framebuf module.
+
+    def text(self, s, x, y, black = True):     # Draw text in the 8x8 framebuf font
+        checkstate(framebuf is not None, 'text() requires framebuf')
+        w = len(s) * 8
+        xa = x + self.ox
+        ya = y + self.oy
+        if xa >= self.cx0 and ya >= self.cy0 and xa + w <= self.cx1 and ya + 8 <= self.cy1:
+            self.framebuffer.text(s, xa, ya, black)
+        else:                                   # Render off screen, blit clips
+            buf = bytearray(len(s) * 8)
+            fb = framebuf.FrameBuffer(buf, w, 8, framebuf.MONO_HMSB)
+            if not black:
+                fb.fill(1)
+            fb.text(s, 0, 0, black)
+            self.blit(buf, w, 8, x, y, OR if black else AND)
+
+    def scroll(self, dx, dy):                   # Shift entire buffer: ignores clipping
+        checkstate(framebuf is not None, 'scroll() requires framebuf')
+        self.framebuffer.scroll(dx, dy)
+
 # ****** Image display ******
 
-    def load_xbm(self, sourcefile, x = 0, y = 0):
-        g = get_xbm_data(sourcefile)
-        width = next(g)
-        height = next(g)
-        self.loadgfx(g, width, height, x, y)
+    def load_xbm(self, sourcefile, x = 0, y = 0, scale = 1, box = False):
+        g = xbm_rows(sourcefile)
+        width, height = next(g)
+        if scale == 1:
+            for n, row in enumerate(g):
+                self.blit(row, width, 1, x, y + n)
+        else:
+            scaler = _Scaler(self, width, height, x, y, scale, box)
+            for row in g:
+                scaler.feed(row)
+
+# Load a binary image file. Where the image is byte aligned and not clipped
+# horizontally rows are read (or decompressed) directly into the buffer. May
+# also be passed a Python image module created by img_to_epd.py.
+    def load_image(self, sourcefile, x = 0, y = 0, scale = 1, box = False):
+        if isinstance(sourcefile, type(uos)):
+            width = sourcefile.width()
+            height = sourcefile.height()
+            if scale == 1:
+                self.blit(sourcefile.data(), width, height, x, y)
+            else:
+                scaler = _Scaler(self, width, height, x, y, scale, box)
+                data = sourcefile.data()
+                stride = (width + 7) >> 3
+                for row in range(height):
+                    scaler.feed(data[row * stride :])
+            return
+        with open(sourcefile, 'rb') as f:
+            width, height, fmt = read_image_header(f, sourcefile)
+            if fmt == IMAGE_RAW:
+                src = f
+            elif fmt == IMAGE_PACKBITS:
+                from packbits import Decoder
+                src = Decoder(f)
+            else:
+                raise ImageFileError('Unsupported format in image file {}'.format(sourcefile))
+            stride = (width + 7) >> 3
+            if scale != 1:
+                scaler = _Scaler(self, width, height, x, y, scale, box)
+                buf = bytearray(stride)
+                for _ in range(height):
+                    src.readinto(buf)
+                    scaler.feed(buf)
+                return
+            xa = x + self.ox                    # Absolute location
+            ya = y + self.oy
+            r0 = max(0, self.cy0 - ya)          # Rows within clip region
+            r1 = min(height, self.cy1 - ya)
+            if r0 >= r1:
+                return
+            if r0 and src is f:
+                f.seek(IMAGE_HEADER_LENGTH + r0 * stride)
+            elif r0:                            # Discard clipped rows
+                buf = bytearray(stride)
+                for _ in range(r0):
+                    src.readinto(buf)
+            if xa >= self.cx0 and xa + width <= self.cx1 and not ((xa | width) & 7):
+                bpl = self.bpl
+                mv = memoryview(self.image)
+                d = (ya + r0) * bpl + (xa >> 3)
+                if stride == bpl:               # Full width
+                    src.readinto(mv[d : d + (r1 - r0) * bpl])
+                else:
+                    for _ in range(r0, r1):
+                        src.readinto(mv[d : d + stride])
+                        d += bpl
+            else:
+                buf = bytearray(stride)
+                for row in range(r0, r1):
+                    src.readinto(buf)
+                    self.blit(buf, width, 1, x, y + row)
+
+# Load an 8 bit greyscale PGM file, dithering it with an 8x8 Bayer matrix. Rows
+# are streamed from the file through a one row buffer.
+    def load_pgm(self, sourcefile, x = 0, y = 0):
+        with open(sourcefile, 'rb') as f:
+            width, height, maxval = _read_pnm_header(f, sourcefile, b'P5', 4)
+            if not 0 < maxval < 256:
+                raise ImageFileError('PGM file {} must have 8 bit pixels'.format(sourcefile))
+            thresh = bytearray(64)              # Scale thresholds to maxval
+            for n in range(64):
+                thresh[n] = ((_BAYER[n] * 4 + 2) * maxval + 254) // 255
+            r0 = max(0, self.cy0 - self.oy - y) # Rows within clip region
+            r1 = min(height, self.cy1 - self.oy - y)
+            if r0 >= r1:
+                return
+            f.seek(f.tell() + r0 * width)
+            grey = bytearray(width)
+            buf = bytearray((width + 7) >> 3)
+            for row in range(r0, r1):
+                if f.readinto(grey) != width:
+                    raise ImageFileError('PGM file {} is truncated'.format(sourcefile))
+                _dither(buf, grey, thresh, width, row & 7)
+                self.blit(buf, width, 1, x, y + row)
 
 # Load a rectangular region with a bitmap supplied by a generator.
 
-    def loadgfx(self, gen, width, height, x0, y0):
-        byteoffset = x0 >> 3
-        bitshift = x0 & 7   # Offset of image relative to byte boundary
-        bytes_per_line = width >> 3
-        if width & 7 > 0:
-            bytes_per_line += 1
+    def loadgfx(self, gen, width, height, x0, y0, scale = 1, box = False):
+        bytes_per_line = (width + 7) >> 3
+        buf = bytearray(bytes_per_line)
+        scaler = None if scale == 1 else _Scaler(self, width, height, x0, y0, scale, box)
         for line in range(height):
-            y = y0 + line
-            if y >= LINES_PER_DISPLAY:
+            if scaler is None and y0 + line + self.oy >= self.cy1:
                 break
-            index = y * BYTES_PER_LINE + byteoffset
-            bitsleft = width
-            x = x0
             for byte in range(bytes_per_line):
-                val = next(gen)
-                bits_to_write = min(bitsleft, 8)
-                x += bits_to_write
-                if x <= BITS_PER_LINE:
-                    if bitshift == 0 and bits_to_write == 8:
-                        self.epd.image[index] = val
-                        index += 1
-                    else:
-                        mask = ((1 << bitshift) -1) # Bits in current byte to preserve
-                        bitsused = bitshift + bits_to_write
-                        overflow = max(0, bitsused -8)
-                        underflow = max(0, 8 -bitsused)
-                        if underflow:               # Underflow in current byte
-                            mask = (mask | ~((1 << bitsused) -1)) & 0xff
-                        nmask = ~mask & 0xff        # Bits to overwrite
-                        self.epd.image[index] = (self.epd.image[index] & mask) | ((val << bitshift) & nmask)
-                        index += 1
-                        if overflow :               # Bits to write to next byte
-                            mask = ~((1 << overflow) -1) & 0xff    # Preserve
-                            self.epd.image[index] = (self.epd.image[index] & mask) | (val >> (8 - bitshift))
-                bitsleft -= bits_to_write
+                buf[byte] = next(gen)
+            if scaler is None:
+                self.blit(buf, width, 1, x0, y0 + line)
+            else:
+                scaler.feed(buf)
+
+# Copy a w * h rectangle of a packed bitmap to x, y. Source rows are stride
+# bytes long (default (w + 7) // 8) and the rectangle starts at sx, sy in the
+# source. Clips to the current region.
+    def blit(self, src, w, h, x, y, op=COPY, *, stride=0, sx=0, sy=0):
+        stride = stride if stride else (w + 7) >> 3
+        x += self.ox
+        y += self.oy
+        d = self.cx0 - x
+        if d > 0:
+            sx += d
+            w -= d
+            x = self.cx0
+        d = self.cy0 - y
+        if d > 0:
+            sy += d
+            h -= d
+            y = self.cy0
+        w = min(w, self.cx1 - x)
+        h = min(h, self.cy1 - y)
+        if w <= 0 or h <= 0:
+            return
+        image = self.image
+        if op == COPY and not ((x | sx) & 7):   # Byte aligned: use memcpy
+            n = w >> 3
+            mask = (1 << (w & 7)) - 1           # Bits used in a partial last byte
+            bpl = self.bpl
+            dmv = memoryview(image)
+            smv = memoryview(src)
+            d = (x >> 3) + y * bpl
+            s = (sx >> 3) + sy * stride
+            if n == stride == bpl:              # Contiguous rows: one copy
+                n *= h
+                h = 1
+            for _ in range(h):
+                dmv[d : d + n] = smv[s : s + n]
+                if mask:
+                    dmv[d + n] = (dmv[d + n] & ~mask) | (smv[s + n] & mask)
+                d += bpl
+                s += stride
+            return
+        p = self.params
+        p[0] = self.bpl
+        p[1] = stride
+        p[2] = sx
+        p[3] = sy
+        p[4] = x
+        p[5] = y
+        p[6] = w
+        p[7] = h
+        p[8] = op
+        _blit(image, src, p)
+
+    def paste(self, canvas, x, y, op=COPY):    # Draw a Canvas at x, y
+        self.blit(canvas.image, canvas.width, canvas.height, x, y, op)
+
+# Select a sprite atlas, loading it on first use. Atlases are cached in the
+# module level dict atlases: delete an entry to free its RAM.
+    def atlas(self, path):
+        if path not in atlases:
+            atlases[path] = Atlas(path)
+        self.cur_atlas = atlases[path]
+        return self.cur_atlas
+
+# Draw a named sprite from the current atlas. Sprites created by img_to_epd.py
+# are byte aligned so drawing at an x which is a multiple of 8 is a memory copy.
+    def sprite(self, name, x, y, op=COPY):
+        a = self.cur_atlas
+        checkstate(a is not None, 'No sprite atlas')
+        sx, sy, w, h = a.sprites[name]
+        self.blit(a.data, w, h, x, y, op, stride=a.stride, sx=sx, sy=sy)
+
+# Load a full frame image via an ImageCache. A cached image is a single copy.
+    def load_cached(self, path, cache=None):
+        if cache is None:
+            if self.image_cache is None:
+                self.image_cache = ImageCache(self.width, self.height)
+            cache = self.image_cache
+        memoryview(self.image)[:] = cache.get(path)
+
+# Show a window onto a VirtualCanvas: its point x, y appears at the origin.
+# Only rows visible in the clip region are read. The VirtualCanvas is retained
+# so that subsequent calls need only pass x and y.
+    def viewport(self, x, y, vcanvas=None):
+        if vcanvas is not None:
+            self.vcanvas = vcanvas
+        vc = self.vcanvas
+        checkstate(vc is not None, 'No virtual canvas')
+        row = max(y + self.cy0 - self.oy, 0)    # Visible rows of virtual canvas
+        end = min(y + self.cy1 - self.oy, vc.height)
+        while row < end:
+            y0, n = vc.cache(row)
+            self.blit(vc.buf, vc.width, n, -x, y0 - y, stride=vc.stride)
+            row = y0 + n
+
+# Save the buffer as a raw binary image file or PBM file. The raw format is
+# written directly from the buffer. old=True saves the previous frame in FAST
+# mode.
+    def save_frame(self, path, fmt=FRAME_RAW, *, old=False):
+        image = memoryview(self._frame(old))
+        with open(path, 'wb') as f:
+            if fmt == FRAME_RAW:
+                f.write(image_header(self.width, self.height))
+                f.write(image)
+            elif fmt == FRAME_PBM:
+                f.write('P4\n{} {}\n'.format(self.width, self.height).encode())
+                n = self.bpl * 8                # Chunk of 8 rows
+                buf = bytearray(n)
+                table = _reverse_table()
+                for start in range(0, len(image), n):
+                    chunk = image[start : start + n]
+                    _bitrev(buf, chunk, table, len(chunk))
+                    f.write(buf if len(chunk) == n else buf[: len(chunk)])
+            else:
+                raise ValueError('Unsupported frame format {}'.format(fmt))
+
+# Restore a frame saved by save_frame() with a single readinto(). The format
+# is detected from the file.
+    def load_frame(self, path, *, old=False):
+        image = self._frame(old)
+        with open(path, 'rb') as f:
+            pbm = f.read(2) == b'P4'
+            f.seek(0)
+            if pbm:
+                width, height = _read_pnm_header(f, path, b'P4', 3)
+                fmt = IMAGE_RAW
+            else:
+                width, height, fmt = read_image_header(f, path)
+            if width != self.width or height != self.height or fmt != IMAGE_RAW:
+                raise ImageFileError('Frame {} does not match the buffer'.format(path))
+            if f.readinto(image) != len(image):
+                raise ImageFileError('Frame {} is truncated'.format(path))
+        if pbm:
+            _bitrev(image, image, _reverse_table(), len(image))
+
+    def _frame(self, old):                      # Buffer for save_frame, load_frame
+        checkstate(not old, 'No previous frame')
+        return self.image
 
 # ****** Text support ******
 
+# Select a font for puts(), returning a context manager. source is the name of a
+# registered font, the path to a binary font file or a Python font module. An
+# unregistered font is opened on entry and closed on exit. Selecting a
+# registered font is a dict lookup: it remains open.
+    def font(self, source, monospaced = False):
+        f = self.fonts.get(source) if isinstance(source, str) else None
+        if f is None:
+            f = self.default_font(source, monospaced)
+        self.current_font = f
+        return f
+
+# Open and validate a font once, keeping it open for use by font(name).
+    def register_font(self, name, source, monospaced = False, cache_size = 12):
+        if name in self.fonts:
+            self.unregister_font(name)
+        f = Font(cache_size)(source, monospaced)
+        f.__enter__()
+        f.persistent = True
+        self.fonts[name] = f
+        return f
+
+    def unregister_font(self, name):           # Close a registered font
+        f = self.fonts.pop(name)
+        f.persistent = False
+        f.__exit__()
+        if self.current_font is f:
+            self.current_font = self.default_font
+
     def locate(self, x, y):                     # set cursor position
         self.char_x = x                         # Text input cursor to (x, y)
         self.char_y = y
@@ -431,69 +1628,549 @@ class Display(object):
 # font.bytes_horiz
 # In cse of font file it's the pysical width of every character as stored in file
 # In case of Python font it's the value of max_width converted to bytes
-    def _character(self, c, usefile):
-        font = self.font                        # Cache for speed
+    def _character(self, c, usefile, wrap = True, scale = 1):
+        font = self.current_font                # Cache for speed
         bits_vert = font.bits_vert
         if usefile:
-            ff = font.fontfile
-            ff.seek(self.FONT_HEADER_LENGTH + (c -32) * (font.bytes_per_ch + 1))
-            buf = ff.read(font.bytes_per_ch + 1)
-            # Characters are stored as constant width.
-            bytes_horiz = font.bytes_horiz      # No. of bytes before next row
+            buf = font.glyph(c)
             # Advance = bits_horiz if variable pitch else font.bits_horiz
             bits_horiz = buf[0]
-            offset = 1
+            # Version 1 characters are stored as constant width.
+            bytes_horiz = (bits_horiz + 7) >> 3 if font.indexed or font.converted else font.bytes_horiz
+            offset = 1                          # Skip width byte
         else:
             modfont = font.modfont
             buf, height, bits_horiz = modfont.get_ch(chr(c))
             # Width varies between characters
             bytes_horiz = (bits_horiz + 7) // 8
             offset = 0
-        # Sanity checks: prevent index errors. Wrapping should be done at string/word level.
-        if (self.char_x + bytes_horiz * 8) > BITS_PER_LINE :
-            self.char_x = 0
-            self.char_y += bits_vert
-        if self.char_y >= (LINES_PER_DISPLAY - bits_vert):
-            self.char_y = 0
-
-        image = self.epd.image
-        y = self.char_y                         # x, y are pixel coordinates
-        for bit_vert in range(bits_vert):       # for each vertical line
-            x = self.char_x
-            for byte_horiz in range(bytes_horiz):
-                fontbyte = buf[bit_vert * bytes_horiz + byte_horiz + offset]
-                index = (x >> 3) + y * BYTES_PER_LINE
-                nbits = x & 0x07
-                if nbits == 0:
-                    image[index] = fontbyte
-                else:
-                    image[index] &= (0xff >> (8 - nbits))
-                    image[index] |= (fontbyte << nbits)
-                    image[index + 1] &= (0xff << nbits)
-                    image[index + 1] |= (fontbyte >> (8 - nbits))
-                x += 8
-            y += 1
-        self.char_x += font.bits_horiz if font.monospaced else bits_horiz
-
-    def _putc(self, value, usefile):            # print char
+        if scale > 1:
+            buf = self._magnify(buf, offset, bytes_horiz, bits_vert, scale)
+            offset = 0
+            bytes_horiz *= scale
+            bits_horiz *= scale
+            bits_vert *= scale
+        # Wrap within the clip region. textbox() wraps at word level.
+        if wrap:
+            if (self.char_x + bytes_horiz * 8) > self.cx1 - self.ox:
+                self.char_x = self.cx0 - self.ox
+                self.char_y += bits_vert
+            if self.char_y >= (self.cy1 - self.oy - bits_vert):
+                self.char_y = self.cy0 - self.oy
+
+        x = self.char_x + self.ox               # Absolute
+        y = self.char_y + self.oy
+        if x >= self.cx0 and y >= self.cy0 and x + bytes_horiz * 8 <= self.cx1 and y + bits_vert <= self.cy1:
+            p = self.params                     # Unclipped: use glyph kernel
+            p[0] = self.bpl
+            p[1] = bytes_horiz
+            p[2] = offset
+            p[3] = x
+            p[4] = y
+            p[5] = bits_vert
+            _glyph(self.image, buf, p)
+        else:
+            self.blit(buf, bytes_horiz * 8, bits_vert, self.char_x, self.char_y, stride=bytes_horiz, sx=offset << 3)
+        end = self.char_x + bytes_horiz * 8     # Extent of pixels written
+        self.char_x += font.bits_horiz * scale if font.monospaced else bits_horiz
+        return end
+
+# Magnify a glyph into a buffer which grows as required. Source rows are
+# bytes_horiz bytes starting at offset.
+    def _magnify(self, buf, offset, bytes_horiz, height, scale):
+        size = bytes_horiz * height * scale * scale
+        if self.scale_buf is None or len(self.scale_buf) < size:
+            self.scale_buf = None
+            gc.collect()
+            self.scale_buf = bytearray(size)
+        p = self.params
+        p[0] = bytes_horiz
+        p[1] = offset
+        p[2] = height
+        p[3] = scale
+        _expand(self.scale_buf, buf, _expansion(scale), p)
+        return self.scale_buf
+
+    def _putc(self, value, usefile, scale = 1): # print char
         if (value == NEWLINE):
-            self.char_x = 0
-            self.char_y += self.font.bits_vert
-            if (self.char_y >= LINES_PER_DISPLAY - self.font.bits_vert):
-                self.char_y = 0
+            bits_vert = self.current_font.bits_vert * scale
+            self.char_x = self.cx0 - self.ox
+            self.char_y += bits_vert
+            if (self.char_y >= self.cy1 - self.oy - bits_vert):
+                self.char_y = self.cy0 - self.oy
         else:
-            self._character(value, usefile)
+            self._character(value, usefile, True, scale)
         return value
 
-    def puts(self, s):                          # Output a string at cursor
-        if self.font.exists:
-            if self.font.modfont is None:       # No font module: using binary file
-                for char in s:
-                    c = ord(char)
-                    if (c > 31 and c < 127) or c == NEWLINE:
-                        self._putc(c, True)
-            else:                               # Python font file is self-checking
-                for char in s:
-                    self._putc(ord(char), False)
+# Output a string at cursor. scale magnifies the font by an integer factor of
+# up to 4.
+    def puts(self, s, scale = 1):
+        font = self.current_font
+        if font.exists:
+            if scale not in (1, 2, 3, 4):
+                raise ValueError('Invalid scale {}'.format(scale))
+            if self.text_cache is not None and s and '\n' not in s and self._puts_cached(s, scale):
+                return
+            usefile = font.modfont is None or font.converted
+            for char in s:
+                self._putc(ord(char), usefile, scale)
         else:
              raise FontFileError("There is no current font")
+
+# Draw a single line string from the text cache, rendering it on a miss. Return
+# False if the string would wrap, in which case it must be drawn normally.
+    def _puts_cached(self, s, scale = 1):
+        font = self.current_font
+        key = (font.fontfilename, font.monospaced, s, scale)
+        entry = self.text_cache.get(key)
+        if entry is None:
+            entry = self._render(s, scale)
+            if entry[0] is None:                # Can't be cached
+                return False
+            self.text_cache.put(key, entry)
+        buf, extent, stride, advance = entry
+        if self.char_x + extent > self.cx1 - self.ox:
+            return False
+        h = font.bits_vert * scale
+        if self.char_y >= self.cy1 - self.oy - h:
+            self.char_y = self.cy0 - self.oy
+        self.blit(buf, extent, h, self.char_x, self.char_y, stride=stride)
+        self.char_x += advance
+        return True
+
+# Render a string to a bitmap. Return the bitmap, the width of the pixels
+# written, its stride and the x advance. If the advance exceeds the glyph width
+# (monospaced rendering) puts() leaves gaps unchanged: the bitmap is None.
+    def _render(self, s, scale = 1):
+        font = self.current_font
+        usefile = font.modfont is None or font.converted
+        h = font.bits_vert * scale
+        canvas = Canvas((self.text_width(s) + font.bytes_horiz * 8) * scale, h)
+        canvas.current_font = font
+        extent = 0
+        for char in s:
+            if canvas.char_x > extent:
+                return None, 0, 0, 0
+            extent = max(extent, canvas._character(ord(char), usefile, False, scale))
+        stride = (extent + 7) >> 3
+        buf = bytearray(stride * h)             # Compact copy
+        mv = memoryview(buf)
+        src = memoryview(canvas.image)
+        for row in range(h):
+            mv[row * stride : (row + 1) * stride] = src[row * canvas.bpl : row * canvas.bpl + stride]
+        return buf, extent, stride, canvas.char_x
+
+    def text_width(self, s, scale = 1):         # Width in pixels of the widest line of s
+        font = self.current_font
+        if not font.exists:
+            raise FontFileError("There is no current font")
+        width = 0
+        w = 0
+        for char in s:
+            c = ord(char)
+            if c == NEWLINE:
+                width = max(width, w)
+                w = 0
+            else:
+                w += font.advance(c)
+        return max(width, w) * scale
+
+# Draw text in the box x0, y0, x1, y1 (inclusive, local coordinates) wrapping
+# at spaces. Newlines start a paragraph. Output is clipped to the box. Returns
+# the y coordinate below the last line, which may lie below the box if the
+# text does not fit. If draw is False the text is measured only.
+    def textbox(self, s, x0, y0, x1, y1, align = LEFT, draw = True):
+        font = self.current_font
+        space = self.text_width(' ')            # Checks font exists
+        width = x1 - x0 + 1
+        y = y0
+        if draw:
+            self.push_clip(x0, y0, x1, y1)
+        try:
+            for para in s.split('\n'):
+                words = para.split(' ')
+                widths = [self.text_width(w) for w in words]
+                start = 0
+                while start < len(words):
+                    end = start + 1             # Fill line with words start..end - 1
+                    w = widths[start]
+                    while end < len(words) and w + space + widths[end] <= width:
+                        w += space + widths[end]
+                        end += 1
+                    if draw and y <= y1:
+                        self._textline(words, start, end, x0, y, max(width - w, 0),
+                                       align, end == len(words))
+                    y += font.bits_vert
+                    start = end
+        finally:
+            if draw:
+                self.pop_clip()
+        self.locate(x0, y)
+        return y
+
+    def _textline(self, words, start, end, x, y, extra, align, last):
+        font = self.current_font
+        usefile = font.modfont is None or font.converted
+        space = font.advance(32)
+        if align == CENTRE:
+            x += extra >> 1
+        elif align == RIGHT:
+            x += extra
+        add = rem = 0
+        if align == JUSTIFY and not last and end - start > 1:
+            add, rem = divmod(extra, end - start - 1)
+        self.char_y = y
+        for n in range(start, end):
+            self.char_x = x
+            for char in words[n]:
+                self._character(ord(char), usefile, False)
+            x = self.char_x + space + add + (1 if n - start < rem else 0)
+
+# An off screen bitmap supporting all drawing and text methods. It may be
+# drawn to the display (or another Canvas) with paste(). Optionally wraps an
+# existing buffer of ((width + 7) // 8) * height bytes.
+class Canvas(Graphics):
+    def __init__(self, width, height, buf=None):
+        self.image = bytearray(((width + 7) >> 3) * height) if buf is None else buf
+        super().__init__(width, height)
+
+    def clear(self, black=False):
+        self.locate(0, 0)
+        fb = self.framebuffer
+        if fb is not None:
+            fb.fill(1 if black else 0)
+        else:
+            image = self.image
+            v = 0xff if black else 0
+            for x in range(len(image)):
+                image[x] = v
+
+# A bitmap larger than the panel stored as a raw image file on flash or SD card.
+# Rows are accessed through a cache holding a band of band_rows rows. If width
+# and height are passed a blank file is created, otherwise an existing file is
+# opened for update.
+class VirtualCanvas(object):
+    def __init__(self, path, width=None, height=None, *, band_rows=16):
+        if width is None:
+            self.file = open(path, 'r+b')
+            width, height, fmt = read_image_header(self.file, path)
+            if fmt != IMAGE_RAW:
+                self.file.close()
+                raise ImageFileError('Virtual canvas {} must be uncompressed'.format(path))
+        else:
+            self.file = open(path, 'w+b')
+            self.file.write(image_header(width, height))
+            row = bytearray((width + 7) >> 3)
+            for _ in range(height):
+                self.file.write(row)
+        self.path = path
+        self.suspended = False
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) >> 3
+        self.band_rows = min(band_rows, height)
+        self.buf = bytearray(self.stride * self.band_rows)
+        self.band = Canvas(width, self.band_rows, self.buf) # Draws into the cached band
+        self.y0 = -1                            # First row in cache: -1 is empty
+        self.dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+# Ensure the band containing row y is cached. Return its first row and the
+# number of valid rows (the last band may be short).
+    def cache(self, y):
+        y0 = y - y % self.band_rows
+        if y0 != self.y0:
+            if self.file is None:
+                raise ImageFileError('Virtual canvas {} is closed'.format(self.path))
+            self.flush()
+            self.file.seek(IMAGE_HEADER_LENGTH + y0 * self.stride)
+            self.file.readinto(self.buf)
+            self.y0 = y0
+        return y0, min(self.band_rows, self.height - y0)
+
+    def flush(self):                            # Write back a modified band
+        if self.dirty and self.file is not None:
+            self.file.seek(IMAGE_HEADER_LENGTH + self.y0 * self.stride)
+            n = min(self.band_rows, self.height - self.y0)
+            self.file.write(memoryview(self.buf)[: n * self.stride])
+            self.dirty = False
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        self.suspended = False
+
+# Close the file while the flash device is unmounted, writing back a modified
+# band, and reopen it by path. The cached band is retained.
+    def suspend(self):
+        if self.file is not None:
+            self.close()
+            self.suspended = True
+
+    def resume(self):
+        if self.suspended:
+            self.file = open(self.path, 'r+b')
+            self.suspended = False
+            self.flush()                        # Band drawn while suspended
+
+# Draw a bitmap into the virtual canvas. Args as for Graphics.blit().
+    def blit(self, src, w, h, x, y, op=COPY, *, stride=0, sx=0, sy=0):
+        row = max(y, 0)
+        end = min(y + h, self.height)
+        while row < end:
+            y0, n = self.cache(row)
+            self.band.blit(src, w, h, x, y - y0, op, stride=stride, sx=sx, sy=sy)
+            self.dirty = True
+            row = y0 + n
+
+    def paste(self, canvas, x, y, op=COPY):    # Draw a Canvas at x, y
+        self.blit(canvas.image, canvas.width, canvas.height, x, y, op)
+
+# Cache of decoded frames keyed by path and modification time. Up to size frames
+# are held in RAM, the least recently used being evicted. If spill is the path
+# to a directory evicted frames are written to it and reloaded with readinto().
+# Images are drawn at 0, 0 on a white background: file type is determined by
+# the extension (.xbm, .pgm, otherwise a binary image file).
+class ImageCache(object):
+    def __init__(self, width=BITS_PER_LINE, height=LINES_PER_DISPLAY, size=2, *, spill=None):
+        self.width = width
+        self.height = height
+        self.size = size
+        self.spill = spill
+        self.frames = {}                        # path: (mtime, buffer)
+        self.lru = []                           # Paths, least recently used first
+        self.spilled = {}                       # path: (mtime, filename)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):                        # Return buffer holding the image
+        mtime = uos.stat(path)[8]
+        entry = self.frames.get(path)
+        if entry is not None:
+            self.lru.remove(path)
+            if entry[0] == mtime:
+                self.lru.append(path)
+                self.hits += 1
+                return entry[1]
+            del self.frames[path]               # Stale: reuse its buffer
+            frame = entry[1]
+        else:
+            frame = self._buffer()
+        self.misses += 1
+        spilled = self.spilled.get(path)
+        if spilled is not None and spilled[0] == mtime:
+            with open(spilled[1], 'rb') as f:
+                f.readinto(frame)
+        else:
+            canvas = Canvas(self.width, self.height, frame)
+            canvas.clear()
+            ext = path[-4:].lower()
+            if ext == '.xbm':
+                canvas.load_xbm(path)
+            elif ext == '.pgm':
+                canvas.load_pgm(path)
+            else:
+                canvas.load_image(path)
+        self.frames[path] = (mtime, frame)
+        self.lru.append(path)
+        return frame
+
+    def _buffer(self):                          # Allocate a buffer or evict LRU entry
+        if len(self.frames) < self.size:
+            return bytearray(((self.width + 7) >> 3) * self.height)
+        path = self.lru.pop(0)
+        mtime, frame = self.frames.pop(path)
+        if self.spill is not None:
+            spilled = self.spilled.get(path)
+            if spilled is None:
+                name = '{}/{}.frm'.format(self.spill, len(self.spilled))
+            else:
+                name = spilled[1]
+            if spilled is None or spilled[0] != mtime:
+                with open(name, 'wb') as f:
+                    f.write(frame)
+                self.spilled[path] = (mtime, name)
+        return frame
+
+    def clear(self):                            # Release all RAM
+        self.frames = {}
+        self.lru = []
+        gc.collect()
+
+# Charged against the budget for each entry in addition to its bitmap. This
+# bounds the number of entries, hence the cost of LRU updates.
+_TEXT_ENTRY_OVERHEAD = const(32)
+
+# LRU cache of rendered strings for puts(), bounded by the total size in bytes
+# of the bitmaps and a per entry overhead.
+class TextCache(object):
+    def __init__(self, budget = 2048):
+        self.budget = budget
+        self.used = 0
+        self.entries = {}                       # (font, monospaced, string): entry
+        self.lru = []                           # Keys, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.lru.remove(key)
+            self.lru.append(key)
+        return entry
+
+    def put(self, key, entry):
+        size = self._size(entry)
+        if size > self.budget:
+            return
+        while self.used + size > self.budget:
+            self.used -= self._size(self.entries.pop(self.lru.pop(0)))
+        self.entries[key] = entry
+        self.lru.append(key)
+        self.used += size
+
+    def clear(self):
+        self.entries = {}
+        self.lru = []
+        self.used = 0
+
+    def _size(self, entry):                     # Bitmap and overhead of key and entry
+        return len(entry[0]) + _TEXT_ENTRY_OVERHEAD
+
+class Display(Graphics):
+    def __init__(self, side='L',*, mode=NORMAL, model=EMBEDDED_ARTISTS, use_flash=False, up_time=None):
+        self.flash = None                       # Assume flash is unused
+        self.in_context = False
+        try:
+            intside = {'l':0, 'r':1}[side.lower()]
+        except (KeyError, AttributeError):
+            raise ValueError("Side must be 'L' or 'R'")
+        if model not in (EMBEDDED_ARTISTS, ADAFRUIT):
+            raise ValueError('Unsupported model')
+        if mode == FAST and use_flash:
+            raise ValueError('Flash memory unavailable in fast mode')
+        if mode == NORMAL and up_time is not None:
+            raise ValueError('Cannot set up_time in normal mode')
+        if mode == NORMAL:
+            from epd import EPD
+            self.epd = EPD(intside, model)
+        elif mode == FAST:
+            from epdpart import EPD
+            self.epd = EPD(intside, model, up_time)
+        else:
+            raise ValueError('Unsupported mode {}'.format(mode))
+        self.mode = mode
+        super().__init__(BITS_PER_LINE, LINES_PER_DISPLAY)
+        gc.collect()
+
+        self.mounted = False                    # umountflash() not to sync
+        if use_flash:
+            from flash import FlashClass
+            gc.collect()
+            self.flash = FlashClass(intside)
+            self.umountflash()                  # In case mounted by prior tests.
+            self.mountflash()
+        gc.collect()
+
+    def checkcm(self):
+        if not (self.mode == NORMAL or self.in_context):
+            raise EPDError('Fast mode must be run using a context manager')
+
+    def __enter__(self):                        # Power up
+        checkstate(self.mode == FAST, "In normal mode, can't use context manager")
+        self.in_context = True
+        self.epd.enter()
+        return self
+
+    def __exit__(self, *_):                     # shut down
+        self.in_context = False
+        self.epd.exit()
+        pass
+
+    def mountflash(self):
+        if self.flash is None:                  # Not being used
+            return
+        self.flash.begin()                      # Initialise.
+        vfs = uos.VfsFat(self.flash)  # Instantiate FAT filesystem
+        uos.mount(vfs, self.flash.mountpoint)
+        self.mounted = True
+        for f in self._flash_files():           # Reopen files closed by umountflash()
+            f.resume()
+
+# Registered font files and the virtual canvas held open on the flash device.
+# Each has suspend() and resume() methods.
+    def _flash_files(self):
+        prefix = self.flash.mountpoint + '/'
+        files = [f for f in self.fonts.values() if f.modfont is None and f.fontfilename.startswith(prefix)]
+        vc = self.vcanvas
+        if vc is not None and vc.path.startswith(prefix):
+            files.append(vc)
+        return files
+
+    def umountflash(self):                      # Unmount flash
+        if self.flash is None:
+            return
+        for f in self._flash_files():
+            f.suspend()
+        if self.mounted:
+            self.flash.synchronise()
+        try:
+            uos.umount(self.flash.mountpoint)
+        except OSError:
+            pass                                # Don't care if it wasn't mounted
+        self.flash.end()                        # Shut down
+        self.mounted = False                    # flag unmounted to prevent spurious syncs
+
+    def show(self):
+        self.checkcm()
+        self.umountflash()                      # sync, umount flash, shut it down and disable SPI
+        if self.mode == NORMAL:                 # EPD functions which access the display electronics must be
+            with self.epd as epd:               # called from a with block to ensure proper startup & shutdown
+                epd.showdata()
+        else:                                   # Fast mode: already in context manager
+            self.epd.showdata()
+        self.mountflash()
+
+    def clear_screen(self, show=True, both=False):
+        self.checkcm()
+        self.locate(0, 0)                       # Reset text cursor
+        self.epd.clear_data(both)
+        if show:
+            if self.mode == NORMAL:
+                self.show()
+            else:
+                self.epd.EPD_clear()
+
+    def refresh(self, fast =True):              # Fast mode only functions
+        checkstate(self.mode == FAST, 'refresh() invalid in normal mode')
+        self.checkcm()
+        self.epd.refresh(fast)
+
+    def exchange(self, clear_data):
+        checkstate(self.mode == FAST, 'exchange() invalid in normal mode')
+        self.checkcm()
+        self.epd.exchange(clear_data)
+
+    @property
+    def image(self):                            # Current buffer: FAST mode swaps buffers
+        return self.epd.image
+
+    def _frame(self, old):
+        if old:
+            checkstate(self.mode == FAST, 'No previous frame in normal mode')
+            return self.epd.image_old
+        return self.epd.image
+
+    @property
+    def temperature(self):                      # return temperature as integer in Celsius
+        return self.epd.temperature
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+# font_subset.py Create a Python font module holding a subset of the characters
+# of a font module produced by font_to_py.py. The output is compatible with
+# Display.font() and may be frozen as bytecode. Runs on a PC under CPython.
+
+# Copyright 2015 Peter Hinch
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#   http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.  See the License for the specific language
+# governing permissions and limitations under the License.
+
+import argparse
+import importlib.util
+import os
+import sys
+
+def load_module(filename):
+    spec = importlib.util.spec_from_file_location('font', filename)
+    font = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(font)
+    if not (font.hmap() and font.reverse()):
+        raise ValueError('{}: font must be created with -xr options'.format(filename))
+    return font
+
+# Characters available in a font. font_to_py.py modules cover 32-126, rendering
+# others as '?', unless they declare a range with min_ch() and max_ch().
+# Modules created by this tool list their characters.
+def available(font):
+    if hasattr(font, 'chars'):
+        return set(font.chars())
+    if hasattr(font, 'min_ch') and hasattr(font, 'max_ch'):
+        return {chr(c) for c in range(font.min_ch(), font.max_ch() + 1)}
+    return {chr(c) for c in range(32, 127)}
+
+# Return glyph data (2 byte width then rows) and a sorted list of (code, offset)
+def subset(font, chars):
+    data = bytearray()
+    index = []
+    height = font.height()
+    for ch in sorted(chars):
+        mv, h, width = font.get_ch(ch)
+        rows = bytes(mv)[: (width + 7) // 8 * height]
+        index.append((ord(ch), len(data)))
+        data += width.to_bytes(2, 'little') + rows
+    if len(data) > 0xffff:
+        raise ValueError('Subset too large for 16 bit offsets')
+    if ord(max(chars)) > 0xffff:
+        raise ValueError('Character codes are limited to 16 bits')
+    return data, index
+
+def write_bytes(f, name, data):
+    f.write('{} =\\\n'.format(name))
+    for n in range(0, len(data), 16):
+        line = ''.join('\\x{:02x}'.format(b) for b in data[n:n + 16])
+        f.write("b'{}'{}\n".format(line, '\\' if n + 16 < len(data) else ''))
+    if not data:
+        f.write("b''\n")
+
+GET_CH = '''
+# ASCII characters are found by direct index, others by binary search of the
+# sparse index. Characters not in the font are rendered as the default.
+def get_ch(ch):
+    c = ord(ch)
+    if c < 128:
+        mid = _ascii[c]
+    else:
+        lo = 0
+        hi = {last}
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            code = int.from_bytes(_sparse[mid * 4 : mid * 4 + 2], 'little')
+            if code == c:
+                break
+            if code < c:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        else:
+            mid = {default}
+    offset = int.from_bytes(_sparse[mid * 4 + 2 : mid * 4 + 4], 'little')
+    width = int.from_bytes(_font[offset : offset + 2], 'little')
+    offset += 2
+    return _mvfont[offset : offset + ((width + 7) // 8) * {height}], {height}, width
+'''
+
+def write_module(filename, font, source, chars, default):
+    data, index = subset(font, chars)
+    codes = [c for c, _ in index]
+    with open(filename, 'w') as f:
+        f.write('# Code generated by font_subset.py.\n')
+        f.write('# Font: {} subset of {} characters\n'.format(os.path.basename(source), len(codes)))
+        f.write("version = '0.1'\n\n")
+        f.write('def height():\n    return {}\n\n'.format(font.height()))
+        f.write('def max_width():\n    return {}\n\n'.format(font.max_width()))
+        f.write('def hmap():\n    return True\n\n')
+        f.write('def reverse():\n    return True\n\n')
+        f.write('def monospaced():\n    return {}\n\n'.format(font.monospaced()))
+        f.write('def chars():\n    return {!r}\n\n'.format(''.join(sorted(chars))))
+        write_bytes(f, '_font', data)
+        f.write('\n_mvfont = memoryview(_font)\n\n')
+        f.write('# Sorted character codes and glyph offsets: 16 bit little endian\n')
+        sparse = b''.join(c.to_bytes(2, 'little') + o.to_bytes(2, 'little') for c, o in index)
+        write_bytes(f, '_sparse', sparse)
+        f.write('\n# Index into _sparse of codes 0-127\n')
+        dflt = codes.index(ord(default))
+        write_bytes(f, '_ascii', bytes(codes.index(c) if c in codes else dflt for c in range(128)))
+        f.write(GET_CH.format(last=len(codes) - 1, default=codes.index(ord(default)), height=font.height()))
+    return len(data) + len(sparse) + 128
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a font module with a subset of characters.')
+    parser.add_argument('infile', help='Python font module')
+    parser.add_argument('outfile', help='Output Python font module')
+    parser.add_argument('-c', '--chars', default='', help='Characters to include')
+    parser.add_argument('-f', '--file', help='UTF-8 text file containing characters to include')
+    parser.add_argument('-d', '--default', default='?',
+                        help='Character rendered in place of missing ones (default ?)')
+    options = parser.parse_args()
+    try:
+        chars = set(options.chars)
+        if options.file:
+            with open(options.file, encoding='utf-8') as f:
+                chars |= set(f.read())
+        chars.discard('\n')
+        chars.add(options.default)
+        font = load_module(options.infile)
+        missing = chars - available(font)
+        if missing:
+            raise ValueError('Characters not in font: {!r}'.format(''.join(sorted(missing))))
+        size = write_module(options.outfile, font, options.infile, chars, options.default)
+    except (OSError, ValueError) as err:
+        print(err)
+        return 1
+    print('{} -> {} ({} characters, {} bytes)'.format(options.infile, options.outfile, len(chars), size))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
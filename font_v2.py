@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+# font_v2.py Convert a version 1 binary font file or a Python font module, as
+# produced by font_to_py.py, to an indexed version 2 binary font file. Runs on a
+# PC under CPython. If the characters are not contiguous, for example a subset
+# holding accented characters, a sparse font is created.
+
+# Copyright 2015 Peter Hinch
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#   http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.  See the License for the specific language
+# governing permissions and limitations under the License.
+
+import argparse
+import struct
+import sys
+from font_subset import load_module, available
+
+FIRST_V1 = 32                                   # Version 1 files hold 32-126
+COUNT_V1 = 95
+FONT_SPARSE = 1                                 # Header flag as defined in epaper.py
+
+# Each reader returns max width, height and a dict of (width, bitmap) indexed
+# by character code. Bitmap rows are (width + 7) // 8 bytes, LSB leftmost.
+
+def read_v1(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:2] != b'\x42\xe7':
+        raise ValueError('{} is not a version 1 binary font'.format(filename))
+    maxw, height = data[2], data[3]
+    bh = (maxw + 7) // 8
+    size = bh * height + 1
+    glyphs = {}
+    for n in range(COUNT_V1):
+        glyph = data[4 + n * size : 4 + (n + 1) * size]
+        if len(glyph) != size:
+            raise ValueError('{} is truncated'.format(filename))
+        width = glyph[0]
+        gh = (width + 7) // 8
+        rows = b''.join(glyph[1 + r * bh : 1 + r * bh + gh] for r in range(height))
+        glyphs[FIRST_V1 + n] = (width, rows)
+    return maxw, height, glyphs
+
+def read_module(filename):
+    font = load_module(filename)
+    glyphs = {}
+    for ch in available(font):
+        mv, height, width = font.get_ch(ch)
+        rows = bytes(mv)[: (width + 7) // 8 * height]
+        if len(rows) != (width + 7) // 8 * height:
+            raise ValueError('{}: bad glyph for character {}'.format(filename, ord(ch)))
+        glyphs[ord(ch)] = (width, rows)
+    return font.max_width(), font.height(), glyphs
+
+# Write glyphs in code order. A contiguous range is stored with its first code,
+# otherwise the sorted codes are written before the offsets.
+def write_v2(filename, maxw, height, glyphs):
+    codes = sorted(glyphs)
+    if codes[-1] > 0xffff:
+        raise ValueError('Character codes are limited to 16 bits')
+    sparse = codes[-1] - codes[0] + 1 != len(codes)
+    offsets = [0]
+    for c in codes:
+        offsets.append(offsets[-1] + 1 + len(glyphs[c][1]))
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<BBBBBBHH', 0x42, 0xe8, maxw, height, FONT_SPARSE if sparse else 0,
+                            0, 0 if sparse else codes[0], len(codes)))
+        if sparse:
+            f.write(struct.pack('<{}H'.format(len(codes)), *codes))
+        f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+        for c in codes:
+            width, rows = glyphs[c]
+            f.write(bytes((width,)))
+            f.write(rows)
+    return 10 + (2 * len(codes) if sparse else 0) + 4 * len(offsets) + offsets[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description='Create an indexed binary font file.')
+    parser.add_argument('infile', help='Version 1 binary font file or Python font module')
+    parser.add_argument('outfile', help='Version 2 binary font file')
+    parser.add_argument('-c', '--chars', help='Characters to include (default all; ? is always included)')
+    options = parser.parse_args()
+    try:
+        if options.infile.endswith('.py'):
+            maxw, height, glyphs = read_module(options.infile)
+        else:
+            maxw, height, glyphs = read_v1(options.infile)
+        if options.chars:
+            wanted = {ord(ch) for ch in options.chars} | {ord('?')}
+            missing = wanted - set(glyphs)
+            if missing:
+                raise ValueError('Characters not in font: {!r}'.format(''.join(chr(c) for c in sorted(missing))))
+            glyphs = {c: glyphs[c] for c in wanted}
+        size = write_v2(options.outfile, maxw, height, glyphs)
+    except (OSError, ValueError) as err:
+        print(err)
+        return 1
+    print('{} -> {} ({} characters, {} bytes)'.format(options.infile, options.outfile, len(glyphs), size))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
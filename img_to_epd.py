@@ -0,0 +1,312 @@
+#! /usr/bin/env python3
+# img_to_epd.py Convert images to binary image files, Python modules or sprite
+# atlases for the Embedded Artists' 2.7 inch E-paper Display. Runs on a PC under
+# CPython.
+# Requires numpy. PGM and PBM files are read natively, other formats (PNG etc.)
+# require Pillow.
+
+# Copyright 2015 Peter Hinch
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#   http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.  See the License for the specific language
+# governing permissions and limitations under the License.
+
+import argparse
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from packbits import encode
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PANEL_WIDTH = 264
+PANEL_HEIGHT = 176
+IMAGE_RAW = 0                                   # Formats as defined in epaper.py
+IMAGE_PACKBITS = 1
+
+ATLAS_NAME_LENGTH = 12
+
+def image_header(width, height, fmt):
+    return bytes((0x49, 0xe7, fmt, 0, width & 0xff, width >> 8, height & 0xff, height >> 8))
+
+def le16(*values):
+    return b''.join(bytes((v & 0xff, v >> 8)) for v in values)
+
+# **** READ IMAGES ****
+
+def _pnm_tokens(data):                          # Parse header tokens skipping comments
+    tokens = []
+    pos = 0
+    while len(tokens) < (3 if data[:2] == b'P4' else 4):
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.find(b'\n', pos)
+            if pos < 0:
+                raise ValueError('Truncated PNM header')
+            continue
+        start = pos
+        while pos < len(data) and not data[pos:pos + 1].isspace():
+            pos += 1
+        if pos >= len(data):
+            raise ValueError('Truncated PNM header')
+        tokens.append(data[start:pos])
+    return tokens, pos + 1                      # Single whitespace precedes data
+
+# Return a 2D float array of grey levels in range 0 (black) to 255 (white).
+def read_pnm(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    tokens, pos = _pnm_tokens(data)
+    width, height = int(tokens[1]), int(tokens[2])
+    if tokens[0] == b'P4':                      # Bitmap: MSB leftmost, 1 is black
+        rowbytes = (width + 7) // 8
+        raw = np.frombuffer(data, np.uint8, rowbytes * height, pos).reshape(height, rowbytes)
+        bits = np.unpackbits(raw, axis=1)[:, :width]
+        return (1 - bits).astype(np.float32) * 255
+    if tokens[0] != b'P5':
+        raise ValueError('{}: only P4 and P5 PNM files are supported'.format(filename))
+    maxval = int(tokens[3])
+    dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+    grey = np.frombuffer(data, dtype, width * height, pos).reshape(height, width)
+    return grey.astype(np.float32) * (255 / maxval)
+
+def read_image(filename, fit):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.pgm', '.pbm', '.pnm') and not fit:
+        return read_pnm(filename)
+    if Image is None:
+        raise ValueError('{}: Pillow is required to read this file'.format(filename))
+    img = Image.open(filename).convert('L')
+    if fit and (img.width > PANEL_WIDTH or img.height > PANEL_HEIGHT):
+        img.thumbnail((PANEL_WIDTH, PANEL_HEIGHT), Image.LANCZOS)
+    return np.asarray(img, dtype=np.float32)
+
+# **** DITHERING ****
+# Each function takes grey levels and returns a boolean array, True for black.
+
+def threshold(grey, level=128):
+    return grey < level
+
+def _bayer(n):                                  # n * n Bayer matrix, n a power of 2
+    m = np.zeros((1, 1), dtype=np.int32)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return m
+
+def bayer(grey, size=8):
+    m = _bayer(size)
+    thresholds = (m + 0.5) * 256 / (size * size)
+    h, w = grey.shape
+    tiled = np.tile(thresholds, (h // size + 1, w // size + 1))[:h, :w]
+    return grey < tiled
+
+def floyd_steinberg(grey):
+    img = grey.astype(np.float32).copy()
+    h, w = img.shape
+    black = np.zeros((h, w), dtype=bool)
+    for y in range(h):
+        row = img[y]
+        below = img[y + 1] if y + 1 < h else None
+        for x in range(w):
+            old = row[x]
+            new = 0.0 if old < 128 else 255.0
+            black[y, x] = new == 0.0
+            err = old - new
+            if x + 1 < w:
+                row[x + 1] += err * 7 / 16
+            if below is not None:
+                if x > 0:
+                    below[x - 1] += err * 3 / 16
+                below[x] += err * 5 / 16
+                if x + 1 < w:
+                    below[x + 1] += err / 16
+    return black
+
+DITHER = {'threshold': threshold, 'bayer': bayer, 'floyd': floyd_steinberg}
+
+# **** OUTPUT ****
+
+# Pack to rows of (width + 7) // 8 bytes, LSB leftmost, as for the display.
+def pack(black):
+    return np.packbits(black, axis=1, bitorder='little').tobytes()
+
+def write_image(filename, data, width, height, compress):
+    with open(filename, 'wb') as f:
+        if compress:
+            f.write(image_header(width, height, IMAGE_PACKBITS))
+            f.write(encode(data))
+        else:
+            f.write(image_header(width, height, IMAGE_RAW))
+            f.write(data)
+
+# Python source which may be frozen as bytecode. The module is compatible with
+# Display.load_image().
+def write_module(filename, data, width, height, source):
+    with open(filename, 'w') as f:
+        f.write('# Code generated by img_to_epd.py.\n')
+        f.write('# Image: {} {}x{}\n'.format(os.path.basename(source), width, height))
+        f.write("version = '0.1'\n\n")
+        f.write('def width():\n    return {}\n\n'.format(width))
+        f.write('def height():\n    return {}\n\n'.format(height))
+        f.write('_data =\\\n')
+        for n in range(0, len(data), 16):
+            line = ''.join('\\x{:02x}'.format(b) for b in data[n:n + 16])
+            f.write("b'{}'{}\n".format(line, '\\' if n + 16 < len(data) else ''))
+        f.write('\ndef data():\n    return memoryview(_data)\n')
+
+# Shelf packing: sprites sorted by height are placed left to right in rows
+# (shelves). Each sprite starts on a byte boundary so that it can be drawn by
+# memory copy. Returns the atlas bitmap and a list of (name, x, y, w, h).
+def pack_atlas(sprites):
+    area = sum(((b.shape[1] + 7) & ~7) * b.shape[0] for _, b in sprites)
+    width = max(max(b.shape[1] for _, b in sprites), int(math.sqrt(area)))
+    width = (width + 7) & ~7
+    sprites = sorted(sprites, key=lambda s: -s[1].shape[0])
+    places = []
+    x = y = shelf = 0
+    for name, black in sprites:
+        h, w = black.shape
+        if x + w > width:
+            x = 0
+            y += shelf
+            shelf = 0
+        places.append((name, x, y, w, h))
+        x += (w + 7) & ~7
+        shelf = max(shelf, h)
+    atlas = np.zeros((y + shelf, width), dtype=bool)
+    for (name, x, y, w, h), (_, black) in zip(places, sprites):
+        atlas[y:y + h, x:x + w] = black
+    return atlas, sorted(places)
+
+# Header: 0x41, 0xe7, count, width, height. Index entries: name padded to 12
+# bytes, x, y, w, h. Then uncompressed rows as for an image file.
+def write_atlas(filename, atlas, places):
+    height, width = atlas.shape
+    with open(filename, 'wb') as f:
+        f.write(b'\x41\xe7' + le16(len(places), width, height))
+        for name, x, y, w, h in places:
+            f.write(name.ljust(ATLAS_NAME_LENGTH, b'\0') + le16(x, y, w, h))
+        f.write(pack(atlas))
+
+EXTENSIONS = {'raw': '.img', 'packbits': '.img', 'py': '.py'}
+
+def render(source, options):                    # Return boolean array, True for black
+    grey = read_image(source, options.fit)
+    if options.invert:
+        grey = 255 - grey
+    if options.dither == 'threshold':
+        return threshold(grey, options.level)
+    return DITHER[options.dither](grey)
+
+def convert(args):                              # Runs in a worker process
+    source, dest, options = args
+    black = render(source, options)
+    if dest is None:                            # Atlas: packed by the parent
+        return source, black
+    height, width = black.shape
+    data = pack(black)
+    if options.format == 'py':
+        write_module(dest, data, width, height, source)
+    else:
+        write_image(dest, data, width, height, options.format == 'packbits')
+    return dest, width, height
+
+IMAGE_TYPES = ('.png', '.pgm', '.pbm', '.pnm', '.bmp', '.gif', '.jpg', '.jpeg', '.tif', '.tiff')
+
+def tasks(options):                             # Yield (source, dest, options)
+    sources = []
+    for name in options.infiles:
+        if os.path.isdir(name):
+            sources.extend(os.path.join(name, f) for f in sorted(os.listdir(name))
+                           if os.path.splitext(f)[1].lower() in IMAGE_TYPES)
+        else:
+            sources.append(name)
+    for source in sources:
+        base = os.path.splitext(os.path.basename(source))[0]
+        if options.atlas:
+            dest = None
+        else:
+            if options.format == 'py':
+                base = base.replace('-', '_')   # Must be a valid module name
+            dest = os.path.join(options.outdir, base + EXTENSIONS[options.format])
+        yield source, dest, options
+
+def sprite_name(source):
+    name = os.path.splitext(os.path.basename(source))[0].encode()
+    if len(name) > ATLAS_NAME_LENGTH:
+        raise ValueError('{}: sprite names are limited to {} characters'.format(source, ATLAS_NAME_LENGTH))
+    return name
+
+def build_atlas(results, options):
+    sprites = [(sprite_name(source), black) for source, black in results]
+    names = [name for name, _ in sprites]
+    if len(set(names)) != len(names):
+        raise ValueError('Duplicate sprite names')
+    atlas, places = pack_atlas(sprites)
+    dest = os.path.join(options.outdir, options.atlas)
+    write_atlas(dest, atlas, places)
+    for name, x, y, w, h in places:
+        print('{:12s} {:4d} {:4d} {:4d} {:4d}'.format(name.decode(), x, y, w, h))
+    print('{} sprites -> {} ({}x{})'.format(len(places), dest, atlas.shape[1], atlas.shape[0]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert images for the e-paper display.')
+    parser.add_argument('infiles', nargs='+', help='Image files or directories of images')
+    parser.add_argument('-o', '--outdir', default='.', help='Output directory (default current)')
+    parser.add_argument('-f', '--format', choices=('raw', 'packbits', 'py'), default='packbits',
+                        help='Output format (default packbits)')
+    parser.add_argument('-d', '--dither', choices=sorted(DITHER), default='floyd',
+                        help='Dithering method (default floyd)')
+    parser.add_argument('-l', '--level', type=int, default=128,
+                        help='Threshold level 0-255 for threshold dithering (default 128)')
+    parser.add_argument('-i', '--invert', action='store_true', help='Invert the image')
+    parser.add_argument('--fit', action='store_true',
+                        help='Scale images larger than 264x176 to fit the panel (requires Pillow)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('--atlas', metavar='FILE',
+                        help='Pack all images into a sprite atlas file, named by file name')
+    options = parser.parse_args()
+    os.makedirs(options.outdir, exist_ok=True)
+    work = list(tasks(options))
+    if not work:
+        print('No images found.')
+        return 1
+    errors = 0
+    results = []
+    with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        futures = [(t[0], pool.submit(convert, t)) for t in work]
+        for source, future in futures:
+            try:
+                if options.atlas:
+                    results.append(future.result())
+                else:
+                    dest, width, height = future.result()
+                    print('{} -> {} ({}x{})'.format(source, dest, width, height))
+            except (OSError, ValueError) as err:
+                print('{}: {}'.format(source, err))
+                errors += 1
+    if options.atlas and not errors:
+        try:
+            build_atlas(results, options)
+        except (OSError, ValueError) as err:
+            print(err)
+            errors += 1
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
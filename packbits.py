@@ -0,0 +1,95 @@
+# packbits.py PackBits run length compression for binary image files.
+# Has no hardware dependencies: may be used on a PC to prepare images.
+
+# Copyright 2015 Peter Hinch
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#   http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied.  See the License for the specific language
+# governing permissions and limitations under the License.
+
+# Each block starts with a header byte n. If n < 128, n + 1 literal bytes
+# follow. If n > 128 the next byte is repeated 257 - n times. 128 is ignored.
+# Runs may span image rows.
+
+def encode(data):                               # Return compressed bytearray
+    out = bytearray()
+    n = len(data)
+    i = 0
+    while i < n:
+        j = i + 1
+        while j < n and j - i < 128 and data[j] == data[i]:
+            j += 1
+        if j - i > 1:                           # Repeat run
+            out.append(257 - (j - i))
+            out.append(data[i])
+        else:                                   # Literal: stop at a run of 3
+            j = i
+            while j < n and j - i < 128:
+                if j + 2 < n and data[j] == data[j + 1] == data[j + 2]:
+                    break
+                j += 1
+            out.append(j - i - 1)
+            out.extend(data[i : j])
+        i = j
+    return out
+
+# Decode a stream from an open file. Only a small fixed read buffer is used.
+class Decoder(object):
+    def __init__(self, f, bufsize=64):
+        self.f = f
+        self.buf = bytearray(bufsize)
+        self.mv = memoryview(self.buf)
+        self.n = 0                              # Valid bytes in buf
+        self.pos = 0                            # Next byte in buf
+        self.run = 0                            # Bytes remaining in current block
+        self.literal = False
+        self.value = 0                          # Repeated value
+
+    def _fill(self):                            # Refill an exhausted buffer
+        self.n = self.f.readinto(self.buf)
+        self.pos = 0
+        if not self.n:
+            raise ValueError('Compressed data truncated')
+
+    def _byte(self):
+        if self.pos >= self.n:
+            self._fill()
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def readinto(self, dest):                   # Fill a writeable buffer
+        n = len(dest)
+        i = 0
+        while i < n:
+            if not self.run:                    # Start a new block
+                h = self._byte()
+                if h < 128:
+                    self.run = h + 1
+                    self.literal = True
+                elif h > 128:
+                    self.run = 257 - h
+                    self.literal = False
+                    self.value = self._byte()
+                continue
+            k = min(self.run, n - i)
+            if self.literal:
+                if self.pos >= self.n:
+                    self._fill()
+                k = min(k, self.n - self.pos)
+                dest[i : i + k] = self.mv[self.pos : self.pos + k]
+                self.pos += k
+            else:
+                v = self.value
+                for j in range(i, i + k):
+                    dest[j] = v
+            i += k
+            self.run -= k
+        return n